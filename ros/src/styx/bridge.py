@@ -2,28 +2,28 @@
 import rospy
 
 import tf
-from geometry_msgs.msg import PoseStamped, Quaternion, TwistStamped
+from geometry_msgs.msg import Pose, PoseArray, PoseStamped, Quaternion, TwistStamped
 from dbw_mkz_msgs.msg import SteeringReport, ThrottleCmd, BrakeCmd, SteeringCmd
 from std_msgs.msg import Float32 as Float
 from std_msgs.msg import Bool
-from sensor_msgs.msg import PointCloud2
-from sensor_msgs.msg import Image
-import sensor_msgs.point_cloud2 as pcl2
+from sensor_msgs.msg import PointCloud2, PointField
+from sensor_msgs.msg import Image, CompressedImage
 from std_msgs.msg import Header
-from cv_bridge import CvBridge, CvBridgeError
 
 from styx_msgs.msg import TrafficLight, TrafficLightArray, Lane
 import numpy as np
-from PIL import Image as PIL_Image
-from io import BytesIO
+import cv2
 import base64
 
 import math
+import struct
+import time
 
 TYPE = {
     'bool': Bool,
     'float': Float,
     'pose': PoseStamped,
+    'pose_array': PoseArray,
     'pcl': PointCloud2,
     'twist': TwistStamped,
     'steer': SteeringReport,
@@ -31,10 +31,26 @@ TYPE = {
     'steer_cmd': SteeringCmd,
     'brake_cmd': BrakeCmd,
     'throttle_cmd': ThrottleCmd,
-    'path_draw': Lane,
-    'image':Image
+    # received raw, callback_path reads the positions straight from the serialized lane
+    'path_draw': rospy.AnyMsg,
+    'image':Image,
+    'compressed_image': CompressedImage
 }
 
+# Number of camera frames between two timing reports
+CAMERA_TIMING_FRAMES = 100
+# Size of a serialized styx_msgs/Waypoint without its two header frame_ids: pose header, pose, twist header, twist
+WAYPOINT_SIZE = 16 + 56 + 16 + 48
+# Number of telemetry messages between two timing reports
+TELEMETRY_TIMING_FRAMES = 500
+# Layout of an x, y, z float32 point cloud, as built by sensor_msgs.point_cloud2.create_cloud_xyz32
+XYZ32_FIELDS = [PointField('x', 0, PointField.FLOAT32, 1),
+                PointField('y', 4, PointField.FLOAT32, 1),
+                PointField('z', 8, PointField.FLOAT32, 1)]
+XYZ32_POINT_STEP = 12
+# Orientation of poses that carry no yaw
+IDENTITY_QUATERNION = (0., 0., 0., 1.)
+
 
 class Bridge(object):
     def __init__(self, conf, server):
@@ -43,7 +59,26 @@ class Bridge(object):
         self.vel = 0.
         self.yaw = None
         self.angular_vel = 0.
-        self.bridge = CvBridge()
+        # camera message reused for every frame, and the time spent in each stage of publish_camera
+        self.image_message = Image()
+        self.image_message.encoding = 'bgr8'
+        self.camera_timing = {'decode': 0., 'convert': 0., 'publish': 0., 'frames': 0}
+        # 'raw' publishes /image_color, 'compressed' passes the simulator JPEG to /image_color/compressed, 'both' does both
+        camera_output = rospy.get_param('~camera_output', 'both')
+        self.publish_raw = camera_output in ('raw', 'both')
+        self.publish_compressed = camera_output in ('compressed', 'both')
+        self.compressed_message = CompressedImage()
+        self.compressed_message.format = 'jpeg'
+        # send every k-th waypoint of /final_waypoints to the simulator, and only when the path moved
+        self.path_decimation = max(int(rospy.get_param('~path_decimation', 1)), 1)
+        self.last_path_bytes = None
+        # long-lived odometry objects, updated in place on every telemetry message
+        self.tf_broadcaster = tf.TransformBroadcaster()
+        self.pose_message = PoseStamped()
+        self.pose_message.header.frame_id = '/world'
+        self.twist_message = TwistStamped()
+        self.telemetry_time = 0.
+        self.telemetry_count = 0
 
         self.callbacks = {
             '/vehicle/steering_cmd': self.callback_steering,
@@ -91,12 +126,6 @@ class Bridge(object):
         fl.data = val
         return fl
 
-    def create_twist(self, velocity, angular):
-        tw = TwistStamped()
-        tw.twist.linear.x = velocity
-        tw.twist.angular.z = angular
-        return tw
-
     def create_steer(self, val):
         st = SteeringReport()
         st.steering_wheel_angle_cmd = val * math.pi/180.
@@ -112,32 +141,60 @@ class Bridge(object):
         self.prev_time = rospy.get_time()
         return angular_vel
 
-    def create_point_cloud_message(self, pts):
-        header = Header()
-        header.stamp = rospy.Time.now()
-        header.frame_id = '/world'
-        cloud_message = pcl2.create_cloud_xyz32(header, pts)
-        return cloud_message
-
-    def broadcast_transform(self, name, position, orientation):
-        br = tf.TransformBroadcaster()
-        br.sendTransform(position,
+    def create_point_cloud_message(self, points, stamp=None):
+        """Packs an (N, 3) array of x, y, z points into a PointCloud2 in one buffer copy"""
+        points = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 3)
+        cloud = PointCloud2()
+        cloud.header.stamp = stamp or rospy.Time.now()
+        cloud.header.frame_id = '/world'
+        cloud.height = 1
+        cloud.width = len(points)
+        cloud.fields = XYZ32_FIELDS
+        cloud.is_bigendian = False
+        cloud.point_step = XYZ32_POINT_STEP
+        cloud.row_step = XYZ32_POINT_STEP * len(points)
+        cloud.is_dense = False
+        cloud.data = points.tostring()
+        return cloud
+
+    def broadcast_transform(self, name, position, orientation, stamp=None):
+        self.tf_broadcaster.sendTransform(position,
             orientation,
-            rospy.Time.now(),
+            stamp or rospy.Time.now(),
             name,
             "world")
 
     def publish_odometry(self, data):
-        pose = self.create_pose(data['x'], data['y'], data['z'], data['yaw'])
-
+        start = time.time()
+        stamp = rospy.Time.now()
+        yaw = math.pi * data['yaw']/180.
+        # a rotation about z only, so the quaternion has a closed form
+        orientation = (0., 0., math.sin(yaw/2.), math.cos(yaw/2.))
         position = (data['x'], data['y'], data['z'])
-        orientation = tf.transformations.quaternion_from_euler(0, 0, math.pi * data['yaw']/180.)
-        self.broadcast_transform("base_link", position, orientation)
+        self.broadcast_transform("base_link", position, orientation, stamp)
 
+        pose = self.pose_message
+        pose.header.stamp = stamp
+        pose.pose.position.x, pose.pose.position.y, pose.pose.position.z = position
+        q = pose.pose.orientation
+        q.x, q.y, q.z, q.w = orientation
         self.publishers['current_pose'].publish(pose)
+
         self.vel = data['velocity']* 0.44704
-        self.angular = self.calc_angular(data['yaw'] * math.pi/180.)
-        self.publishers['current_velocity'].publish(self.create_twist(self.vel, self.angular))
+        self.angular = self.calc_angular(yaw)
+        twist = self.twist_message
+        twist.twist.linear.x = self.vel
+        twist.twist.angular.z = self.angular
+        self.publishers['current_velocity'].publish(twist)
+        self.report_telemetry_timing(time.time() - start)
+
+    def report_telemetry_timing(self, elapsed):
+        self.telemetry_time += elapsed
+        self.telemetry_count += 1
+        if self.telemetry_count == TELEMETRY_TIMING_FRAMES:
+            rospy.logdebug("Telemetry ms per message: %.3f", 1000. * self.telemetry_time / TELEMETRY_TIMING_FRAMES)
+            self.telemetry_time = 0.
+            self.telemetry_count = 0
 
 
     def publish_controls(self, data):
@@ -147,17 +204,29 @@ class Bridge(object):
         self.publishers['brake_report'].publish(self.create_float(brake))
 
     def publish_obstacles(self, data):
-        for obs in data['obstacles']:
-            pose = self.create_pose(obs[0], obs[1], obs[2])
-            self.publishers['obstacle'].publish(pose)
-        header = Header()
-        header.stamp = rospy.Time.now()
-        header.frame_id = '/world'
-        cloud = pcl2.create_cloud_xyz32(header, data['obstacles'])
-        self.publishers['obstacle_points'].publish(cloud)
+        obstacles = np.asarray(data['obstacles'], dtype=np.float64).reshape(-1, 3)
+        # the whole batch goes out as one PoseArray, obstacles carry no yaw so they share one orientation
+        batch = PoseArray()
+        batch.header.stamp = rospy.Time.now()
+        batch.header.frame_id = '/world'
+        for x, y, z in obstacles.tolist():
+            pose = Pose()
+            pose.position.x, pose.position.y, pose.position.z = x, y, z
+            pose.orientation = Quaternion(*IDENTITY_QUATERNION)
+            batch.poses.append(pose)
+        self.publishers['obstacles'].publish(batch)
+        # the one message per obstacle topic is kept for compatibility, and skipped while nobody listens
+        if self.publishers['obstacle'].get_num_connections() > 0:
+            for pose in batch.poses:
+                stamped = PoseStamped()
+                stamped.header = batch.header
+                stamped.pose = pose
+                self.publishers['obstacle'].publish(stamped)
+        self.publishers['obstacle_points'].publish(self.create_point_cloud_message(obstacles, batch.header.stamp))
 
     def publish_lidar(self, data):
-        self.publishers['lidar'].publish(self.create_point_cloud_message(zip(data['lidar_x'], data['lidar_y'], data['lidar_z'])))
+        points = np.column_stack((data['lidar_x'], data['lidar_y'], data['lidar_z']))
+        self.publishers['lidar'].publish(self.create_point_cloud_message(points))
 
     def publish_traffic(self, data):
         x, y, z = data['light_pos_x'], data['light_pos_y'], data['light_pos_z'],
@@ -175,12 +244,42 @@ class Bridge(object):
         self.publishers['dbw_status'].publish(Bool(data))
 
     def publish_camera(self, data):
-        imgString = data["image"]
-        image = PIL_Image.open(BytesIO(base64.b64decode(imgString)))
-        image_array = np.asarray(image)
+        start = time.time()
+        jpeg = base64.b64decode(data["image"])
+        stamp = rospy.Time.now()
+        if self.publish_compressed:
+            # the simulator already sends a JPEG, so it is passed through untouched
+            self.compressed_message.header.stamp = stamp
+            self.compressed_message.data = jpeg
+            self.publishers['image_compressed'].publish(self.compressed_message)
+        # decoding is only worth it when someone listens to the raw images
+        if not self.publish_raw or self.publishers['image'].get_num_connections() == 0:
+            return
+
+        # decode the JPEG straight from the base64 bytes, OpenCV gives BGR so no channel swap is needed
+        image_array = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        decoded = time.time()
+
+        image_message = self.image_message
+        image_message.header.stamp = stamp
+        image_message.height, image_message.width = image_array.shape[:2]
+        image_message.step = image_message.width * 3
+        image_message.data = image_array.tostring()
+        converted = time.time()
 
-        image_message = self.bridge.cv2_to_imgmsg(image_array, encoding="rgb8")
         self.publishers['image'].publish(image_message)
+        self.report_camera_timing(decoded - start, converted - decoded, time.time() - converted)
+
+    def report_camera_timing(self, decode, convert, publish):
+        timing = self.camera_timing
+        timing['decode'] += decode
+        timing['convert'] += convert
+        timing['publish'] += publish
+        timing['frames'] += 1
+        if timing['frames'] == CAMERA_TIMING_FRAMES:
+            rospy.logdebug("Camera ms per frame: decode %.2f, convert %.2f, publish %.2f",
+                           *[1000. * timing[stage] / CAMERA_TIMING_FRAMES for stage in ('decode', 'convert', 'publish')])
+            self.camera_timing = {'decode': 0., 'convert': 0., 'publish': 0., 'frames': 0}
 
     def callback_steering(self, data):
         self.server('steer', data={'steering_angle': str(data.steering_wheel_angle_cmd)})
@@ -191,16 +290,47 @@ class Bridge(object):
     def callback_brake(self, data):
         self.server('brake', data={'brake': str(data.pedal_cmd)})
 
+    def unpack_path(self, buff, start):
+        """Reads the waypoint positions of a serialized styx_msgs/Lane
+
+        Args:
+            buff (str): the serialized lane
+            start (int): offset of the waypoint array in `buff`, just past the lane header
+
+        Returns:
+            ndarray: (N, 3) x, y, z positions, a view into `buff` when the waypoints have a fixed size
+
+        """
+        count, = struct.unpack_from('<I', buff, start)
+        start += 4
+        if count == 0:
+            return np.zeros((0, 3))
+        # the waypoints all have the same size, and so can be read with one strided view, when their frame_ids do
+        pose_frame_id_length, = struct.unpack_from('<I', buff, start + 12)
+        position = start + 16 + pose_frame_id_length
+        twist_frame_id_length, = struct.unpack_from('<I', buff, position + 56 + 12)
+        stride = WAYPOINT_SIZE + pose_frame_id_length + twist_frame_id_length
+        if len(buff) == start + count * stride:
+            pose_frame_ids = np.ndarray((count,), '<u4', buffer=buff, offset=start + 12, strides=(stride,))
+            twist_frame_ids = np.ndarray((count,), '<u4', buffer=buff, offset=position + 56 + 12, strides=(stride,))
+            if (pose_frame_ids == pose_frame_id_length).all() and (twist_frame_ids == twist_frame_id_length).all():
+                return np.ndarray((count, 3), '<f8', buffer=buff, offset=position, strides=(stride, 8))
+        lane = Lane().deserialize(buff)
+        return np.array([(wp.pose.pose.position.x, wp.pose.pose.position.y, wp.pose.pose.position.z)
+                         for wp in lane.waypoints]).reshape(-1, 3)
+
     def callback_path(self, data):
-        x_values = []
-        y_values = []
-        z_values = []
-        for waypoint in data.waypoints:
-            x = waypoint.pose.pose.position.x
-            y = waypoint.pose.pose.position.y
-            z = waypoint.pose.pose.position.z+0.5
-            x_values.append(x)
-            y_values.append(y)
-            z_values.append(z)
-
-        self.server('drawline', data={'next_x': x_values, 'next_y': y_values, 'next_z': z_values})
+        buff = data._buff
+        # the lane header is seq, stamp secs and nsecs, then frame_id as a length prefixed string
+        frame_id_length, = struct.unpack_from('<I', buff, 12)
+        start = 16 + frame_id_length
+        # compare the waypoints as bytes before unpacking anything, the header seq changes on every message
+        path_bytes = buff[start:]
+        if path_bytes == self.last_path_bytes:
+            return
+        self.last_path_bytes = path_bytes
+
+        path = self.unpack_path(buff, start)[::self.path_decimation]
+        # draw the line slightly above the road
+        self.server('drawline', data={'next_x': path[:, 0].tolist(), 'next_y': path[:, 1].tolist(),
+                                      'next_z': (path[:, 2] + 0.5).tolist()})
@@ -14,10 +14,12 @@ conf = AttrDict({
         {'topic': '/vehicle/throttle_report', 'type': 'float', 'name': 'throttle_report'},
         {'topic': '/vehicle/brake_report', 'type': 'float', 'name': 'brake_report'},
         {'topic': '/vehicle/obstacle', 'type': 'pose', 'name': 'obstacle'},
+        {'topic': '/vehicle/obstacles', 'type': 'pose_array', 'name': 'obstacles'},
         {'topic': '/vehicle/obstacle_points', 'type': 'pcl', 'name': 'obstacle_points'},
         {'topic': '/vehicle/lidar', 'type': 'pcl', 'name': 'lidar'},
         {'topic': '/vehicle/traffic_lights', 'type': 'trafficlights', 'name': 'trafficlights'},
         {'topic': '/vehicle/dbw_enabled', 'type': 'bool', 'name': 'dbw_status'},
         {'topic': '/image_color', 'type': 'image', 'name': 'image'},
+        {'topic': '/image_color/compressed', 'type': 'compressed_image', 'name': 'image_compressed'},
     ]
 })
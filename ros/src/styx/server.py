@@ -6,14 +6,41 @@ eventlet.monkey_patch(socket=True, select=True, time=True)
 import eventlet.wsgi
 import socketio
 import time
+import rospy
+# threading is not monkey patched, so this gives real OS threads
+import threading
+from collections import deque
 from flask import Flask, render_template
 
+from waypoint_lib import LatestFrame
+
 from bridge import Bridge
 from conf import conf
 
 sio = socketio.Server()
 app = Flask(__name__)
-msgs = []
+
+
+class Outbox(object):
+    # keeps only the newest message per topic, emitted in the order the topics were first queued
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.order = deque()
+
+    def put(self, topic, data):
+        with self.lock:
+            if topic not in self.latest:
+                self.order.append(topic)
+            self.latest[topic] = data
+
+    def drain(self):
+        with self.lock:
+            msgs = [(topic, self.latest.pop(topic)) for topic in self.order]
+            self.order.clear()
+        return msgs
+
+outbox = Outbox()
 
 dbw_enable = False
 
@@ -22,12 +49,23 @@ def connect(sid, environ):
     print("connect ", sid)
 
 def send(topic, data):
-    s = 1
-    msgs.append((topic, data))
+    outbox.put(topic, data)
     #sio.emit(topic, data=json.dumps(data), skip_sid=True)
 
 bridge = Bridge(conf, send)
 
+
+latest_image = LatestFrame()
+
+def publish_camera(data):
+    bridge.publish_camera(data)
+    rospy.logdebug('Camera frame published. Frames dropped: %d', latest_image.dropped)
+
+# decodes and publishes frames away from the eventlet loop, so telemetry is never held up
+camera_thread = threading.Thread(target=latest_image.serve, args=(publish_camera, 'Publishing the camera'))
+camera_thread.daemon = True
+camera_thread.start()
+
 @sio.on('telemetry')
 def telemetry(sid, data):
     global dbw_enable
@@ -35,8 +73,7 @@ def telemetry(sid, data):
         dbw_enable = data["dbw_enable"]
         bridge.publish_dbw_status(dbw_enable)
     bridge.publish_odometry(data)
-    for i in range(len(msgs)):
-        topic, data = msgs.pop(0)
+    for topic, data in outbox.drain():
         sio.emit(topic, data=data, skip_sid=True)
 
 @sio.on('control')
@@ -57,7 +94,7 @@ def trafficlights(sid, data):
 
 @sio.on('image')
 def image(sid, data):
-    bridge.publish_camera(data)
+    latest_image.put(data)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,33 @@
+import rospy
+import cv2
+from sensor_msgs.msg import Image
+from cv_bridge import CvBridge
+
+# Box colors (BGR) for red, green, yellow and unknown predictions
+BOX_COLORS = [(0,0,255), (0,255,0), (0,225,255), (255,225,255)]
+
+
+class DebugOverlayPublisher(object):
+    """Publishes camera images annotated with the classified traffic light boxes.
+
+    Only imported by tl_detector when ~debug_overlay is set, so normal runs do not pay for it.
+    """
+
+    def __init__(self, topic='/tl_detector/debug_image'):
+        self.bridge = CvBridge()
+        self.pub = rospy.Publisher(topic, Image, queue_size=1)
+
+    def publish(self, image, detections):
+        """Draws the detections on the image and publishes it
+
+        Args:
+            image (cv::Mat): BGR image that was classified, drawn on in place
+            detections (list): ((left, right, top, bottom), prediction) pairs from TLClassifier
+
+        """
+        # nobody is watching, skip the drawing and the conversion
+        if self.pub.get_num_connections() == 0:
+            return
+        for (left, right, top, bottom), pred in detections:
+            cv2.rectangle(image, (left, top), (right, bottom), BOX_COLORS[pred], 4)
+        self.pub.publish(self.bridge.cv2_to_imgmsg(image, "bgr8"))
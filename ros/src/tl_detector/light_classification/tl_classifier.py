@@ -2,25 +2,35 @@ from styx_msgs.msg import TrafficLight
 import numpy as np
 import tensorflow as tf
 import rospy
-import matplotlib.pyplot as plt
 import cv2
 import time
+import os
+
+# Folder holding model_detect/ and model_clf/, the tl_detector package directory
+MODEL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_graph(path):
+    """Loads a frozen inference graph from an absolute path"""
+    graph = tf.Graph()
+    with graph.as_default():
+        od_graph_def = tf.GraphDef()
+
+        with tf.gfile.GFile(path, 'rb') as fid:
+            serialized_graph = fid.read()
+            od_graph_def.ParseFromString(serialized_graph)
+            tf.import_graph_def(od_graph_def, name='')
+    return graph
+
 
 class TLClassifier(object):
-    def __init__(self):
+    def __init__(self, model_dir=MODEL_DIR):
         
         print "\nTraffic light detection is loading, please wait...\n"
+        start = time.time()
         # Load traffic light detector (Tensorflow's pretrained Mobilenet)
-        PATH_TO_MODEL =  'model_detect/frozen_inference_graph.pb'  
-        detection_graph = tf.Graph()
-
-        with detection_graph.as_default():
-            od_graph_def = tf.GraphDef()
-
-            with tf.gfile.GFile(PATH_TO_MODEL, 'rb') as fid:
-                serialized_graph = fid.read()
-                od_graph_def.ParseFromString(serialized_graph)
-                tf.import_graph_def(od_graph_def, name='')
+        PATH_TO_MODEL = os.path.join(model_dir, 'model_detect', 'frozen_inference_graph.pb')
+        detection_graph = load_graph(PATH_TO_MODEL)
                 
         self.sess_detect = tf.Session(graph=detection_graph)
         # Placeholders and graphs
@@ -30,16 +40,8 @@ class TLClassifier(object):
         self.classes = detection_graph.get_tensor_by_name('detection_classes:0')
 
         # Load traffic light classifier
-        PATH_TO_CLASSIFIER =  'model_clf/frozen_inference_graph.pb'
-        
-        clf_graph = tf.Graph()
-        with clf_graph.as_default():
-            od_graph_def = tf.GraphDef()
-
-            with tf.gfile.GFile(PATH_TO_CLASSIFIER, 'rb') as fid:
-                serialized_graph = fid.read()
-                od_graph_def.ParseFromString(serialized_graph)
-                tf.import_graph_def(od_graph_def, name='')
+        PATH_TO_CLASSIFIER = os.path.join(model_dir, 'model_clf', 'frozen_inference_graph.pb')
+        clf_graph = load_graph(PATH_TO_CLASSIFIER)
 
         self.sess_clf = tf.Session(graph=clf_graph)
         # Placeholders and graphs
@@ -51,10 +53,22 @@ class TLClassifier(object):
         self.DETECTION_THRESHOLD = 0.1
         self.MAX_NUM_BOXES = 3
         self.IM_HEIGHT, self.IM_WIDTH = 600, 800
-        # Draws boxes and shows images if set to true
-        self.DRAW_BOXES = False
+        # Input size of the classifier
+        self.CLF_HEIGHT, self.CLF_WIDTH = 60, 20
+        # Boxes and predictions of the last classified image, kept for the debug overlay
+        self.last_detections = []
+
+        self.warm_up()
+        self.load_time = time.time() - start
 
-        print "Traffic light detection is loaded"
+        print "Traffic light detection is loaded in %.2f s" % self.load_time
+
+    def warm_up(self):
+        # the first run of each graph pays for its optimisation, so do it before the car needs a result
+        self.sess_detect.run([self.boxes, self.scores, self.classes],
+                             feed_dict={self.image_tensor_detect: np.zeros((1, self.IM_HEIGHT, self.IM_WIDTH, 3), dtype=np.uint8)})
+        self.sess_clf.run(self.classify_tl, {self.image_tensor_clf : np.zeros((1, self.CLF_HEIGHT, self.CLF_WIDTH, 3), dtype=np.float32),
+                                             self.keep_prob : 1.})
 
     def get_classification(self, image):
         """Determines the color of the traffic light in the image
@@ -80,52 +94,42 @@ class TLClassifier(object):
         scores = np.where(scores<self.DETECTION_THRESHOLD, 0, scores)
         #rospy.logerr("np.max(scores) %s", np.max(scores))
 
-        # Draw box around the traffic light
-        green = 0
-        red = 0
-        yellow = 0
+        # Keep the highest scoring traffic lights, up to MAX_NUM_BOXES of them
+        best = np.argsort(scores)[::-1][:self.MAX_NUM_BOXES]
+        best = best[scores[best] != 0]
 
-        for n_boxes in range(len(boxes)):
-            i = np.argmax(scores)
-            if scores[i] != 0 and n_boxes < self.MAX_NUM_BOXES:
-                scores[i] = 0.
-        
-                left, right, top, bottom = (int(boxes[i, 1] * self.IM_WIDTH), 
-                                            int(boxes[i, 3] * self.IM_WIDTH), 
-                                            int(boxes[i, 0] * self.IM_HEIGHT), 
-                                            int(boxes[i, 2] * self.IM_HEIGHT))
-
-                clf_img = image.copy()
-                clf_img = clf_img[top : bottom, left : right] / 255.
-                # Resize cropped image
-                clf_img = cv2.resize(clf_img, (20, 60)) 
-                # Traffic light classification
-                pred = self.sess_clf.run(self.classify_tl, {self.image_tensor_clf : clf_img[np.newaxis,:,:,:], self.keep_prob : 1.})
-                pred = np.argmax(pred) 
-                   
-                if pred == 0:
-                    red += 1
-                    if self.DRAW_BOXES:    
-                        cv2.rectangle(image, (left, top),(right, bottom), (0,0,255), 4)
-                elif pred == 1:
-                    green += 1
-                    if self.DRAW_BOXES:    
-                        cv2.rectangle(image, (left, top),(right, bottom), (0,255,0), 4)
-                elif pred == 2:
-                    yellow += 1
-                    if self.DRAW_BOXES:    
-                        cv2.rectangle(image, (left, top),(right, bottom), (0,225,255), 4)
-                elif pred == 3:
-                    if self.DRAW_BOXES:    
-                        cv2.rectangle(image, (left, top),(right, bottom), (255,225,255), 4)
-            else:
-                break
+        # Boxes are relative to the input, which may be a region cropped from the camera frame
+        im_height, im_width = image.shape[:2]
+
+        # Crop every box from the frame without copying it and stack the resized crops into one batch
+        box_corners = []
+        clf_batch = np.empty((len(best), self.CLF_HEIGHT, self.CLF_WIDTH, 3), dtype=np.float32)
+        for i in best:
+            left, right, top, bottom = (int(boxes[i, 1] * im_width),
+                                        int(boxes[i, 3] * im_width),
+                                        int(boxes[i, 0] * im_height),
+                                        int(boxes[i, 2] * im_height))
+            if right <= left or bottom <= top:
+                continue
+            clf_batch[len(box_corners)] = cv2.resize(image[top : bottom, left : right], (self.CLF_WIDTH, self.CLF_HEIGHT))
+            box_corners.append((left, right, top, bottom))
+        n_boxes = len(box_corners)
+
+        red = green = yellow = 0
+        self.last_detections = []
+        if n_boxes:
+            clf_batch = clf_batch[:n_boxes]
+            clf_batch /= 255.
+            # Traffic light classification of all boxes in one session call
+            preds = self.sess_clf.run(self.classify_tl, {self.image_tensor_clf : clf_batch, self.keep_prob : 1.})
+            preds = np.argmax(preds, axis=1)
+            red = np.count_nonzero(preds == 0)
+            green = np.count_nonzero(preds == 1)
+            yellow = np.count_nonzero(preds == 2)
+            self.last_detections = list(zip(box_corners, preds))
         
         #elapsed_time = time.time() - start
         #rospy.logerr("time: %s", elapsed_time)
-        if self.DRAW_BOXES:
-            plt.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-            plt.show()
 
         if n_boxes:
             if red > green and red > yellow:
@@ -1,19 +1,31 @@
 #!/usr/bin/env python
 import rospy
-from std_msgs.msg import Int32
+from std_msgs.msg import Int32, Bool
 from geometry_msgs.msg import PoseStamped, Pose, TwistStamped
 from styx_msgs.msg import TrafficLightArray, TrafficLight
-from styx_msgs.msg import Lane
-from sensor_msgs.msg import Image
+from sensor_msgs.msg import Image, CompressedImage, CameraInfo
 from cv_bridge import CvBridge
-from light_classification.tl_classifier import TLClassifier
+from light_classification.tl_classifier import TLClassifier, MODEL_DIR
 import tf
 import cv2
 import yaml
 import math
+import threading
 import numpy as np
 
+from waypoint_lib import LatestFrame, track_index_from_raw
+
 STATE_COUNT_THRESHOLD = 3
+# Half size in metres of the region cropped around the projected traffic light
+LIGHT_ROI_HALF_WIDTH = 2.0
+LIGHT_ROI_HALF_HEIGHT = 3.0
+# Smallest half size in pixels of the cropped region, so far away lights keep some context
+MIN_ROI_HALF_SIZE = 32
+# Height in metres assumed for a light that is only known by its stop line
+DEFAULT_LIGHT_HEIGHT = 3.0
+# Longest time in seconds between classifications while the next stop line is out of braking range
+MAX_CLASSIFY_PERIOD = 2.0
+
 
 class TLDetector(object):
     def __init__(self):
@@ -21,9 +33,43 @@ class TLDetector(object):
 
         #Get the maximum velocity parameter
         self.maximum_velocity = self.kmph2mps(rospy.get_param('~velocity')) # change km/h to m/s
+        #Classify the camera images instead of using the simulator's light states
+        self.use_classifier = rospy.get_param('~use_classifier', False)
 
         config_string = rospy.get_param("/traffic_light_config")
         self.config = yaml.load(config_string)
+        #Crop the camera image around the expected traffic light before detection
+        self.use_roi = rospy.get_param('~use_roi', True)
+        #Throttle the classifier while the next stop line is too far away to brake for
+        self.gate_classifier = rospy.get_param('~gate_classifier', True)
+        #Publish the classified images with their boxes drawn on a debug topic
+        self.debug_overlay = None
+        if rospy.get_param('~debug_overlay', False):
+            from light_classification.debug_overlay import DebugOverlayPublisher
+            self.debug_overlay = DebugOverlayPublisher()
+        self.last_classification_time = 0
+        # fx, fy, cx, cy of the camera. /camera_info overrides the focal lengths from the config
+        self.camera_intrinsics = None
+        camera_config = self.config.get('camera_info', {})
+        if 'focal_length_x' in camera_config and 'focal_length_y' in camera_config:
+            self.camera_intrinsics = (camera_config['focal_length_x'], camera_config['focal_length_y'],
+                                      camera_config['image_width'] / 2., camera_config['image_height'] / 2.)
+        # the camera pose in base_link: its x, y, z offset in metres and its downward pitch in radians.
+        # The defaults put the camera at the base_link origin looking straight ahead
+        self.camera_offset = np.array(rospy.get_param('~camera_offset', [0., 0., 0.]), dtype=np.float64)
+        camera_pitch = rospy.get_param('~camera_pitch', 0.)
+        self.camera_forward = np.array([math.cos(camera_pitch), 0., -math.sin(camera_pitch)])
+        self.camera_up = np.array([math.sin(camera_pitch), 0., math.cos(camera_pitch)])
+        self.vehicle_traffic_lights = None
+        self.stop_line_positions = np.array(self.config['stop_line_positions'])
+        # Light positions for the crop while /vehicle/traffic_lights is not published, as on the site:
+        # light_positions from the config, else the stop lines raised to ~light_height
+        if 'light_positions' in self.config:
+            self.config_light_positions = np.array(self.config['light_positions'], dtype=np.float64)
+        else:
+            light_height = rospy.get_param('~light_height', DEFAULT_LIGHT_HEIGHT)
+            self.config_light_positions = np.column_stack((self.stop_line_positions,
+                                                           np.full(len(self.stop_line_positions), light_height)))
         # rospy.loginfo("The config type: " + str(type(self.config)))
         # rospy.loginfo("The config sub type: " + str(type(self.config.keys)))
         # rospy.loginfo("The config sub sub type: " + str(self.config))
@@ -34,6 +80,8 @@ class TLDetector(object):
         self.camera_image = None
         self.current_pose = None
         self.base_waypoints = None
+        self.track_index = None
+        self.stop_line_waypoints = None
         self.lights = []
         self.c_image = None
 
@@ -41,7 +89,8 @@ class TLDetector(object):
         self.stopping_waypoint_distance = 1000
         self.nearest_light_index = None
 
-        self.base_waypoints_sub = rospy.Subscriber('/base_waypoints', Lane, self.waypoints_cb)
+        # received raw, so the lane is only deserialized when the loader's shared track cannot be attached
+        self.base_waypoints_sub = rospy.Subscriber('/base_waypoints', rospy.AnyMsg, self.waypoints_cb)
         self.current_pose_sub = rospy.Subscriber('/current_pose', PoseStamped, self.pose_cb)
         # self.vehicle_traffic_lights_sub = rospy.Subscriber('/vehicle/traffic_lights', TrafficLightArray, self.traffic_cb)
         self.current_velocity = 0
@@ -56,6 +105,7 @@ class TLDetector(object):
         rely on the position of the light and the camera image to predict it.
         '''
         # sub6_sub = rospy.Subscriber('/image_color', Image, self.image_cb_function)
+        self.frame_slot = LatestFrame()
 
 
 
@@ -76,8 +126,29 @@ class TLDetector(object):
         self.Red_Light = 0
         
         self.loop_rate = 2
-        self.loop()
-        # rospy.spin()
+        if self.use_classifier:
+            # latched, so nodes started later still see whether the classifier is usable
+            self.ready_pub = rospy.Publisher('/tl_detector/ready', Bool, queue_size=1, latch=True)
+            self.ready_pub.publish(False)
+            self.light_classifier = TLClassifier(rospy.get_param('~model_dir', MODEL_DIR))
+            rospy.loginfo("Traffic light classifier ready after %.2f s", self.light_classifier.load_time)
+            self.ready_pub.publish(True)
+            self.camera_info_sub = rospy.Subscriber('/camera_info', CameraInfo, self.camera_info_cb)
+            self.vehicle_traffic_lights_sub = rospy.Subscriber('/vehicle/traffic_lights', TrafficLightArray, self.traffic_cb)
+            # a large buffer keeps rospy from queueing partially read images behind the latest one
+            if rospy.get_param('~compressed_image', False):
+                self.image_sub = rospy.Subscriber('/image_color/compressed', CompressedImage, self.image_cb_function, queue_size=1, buff_size=2**24)
+            else:
+                self.image_sub = rospy.Subscriber('/image_color', Image, self.image_cb_function, queue_size=1, buff_size=2**24)
+            # runs on its own thread so camera and pose callbacks never wait for the classifier
+            self.inference_thread = threading.Thread(target=self.frame_slot.serve,
+                                                     args=(self.image_cb, 'Traffic light detection'))
+            self.inference_thread.daemon = True
+            self.inference_thread.start()
+            rospy.on_shutdown(self.frame_slot.close)
+            rospy.spin()
+        else:
+            self.loop()
 
     def loop(self):
         rate = rospy.Rate(self.loop_rate) # 1Hz
@@ -118,7 +189,7 @@ class TLDetector(object):
         if self.prev_pose is None or np.all(self.prev_pose == self.pose):
             self.prev_pose = self.pose - 0.1
         # find the distances from the current position and the stop lines
-        stop_line_positions = np.array(self.config['stop_line_positions'])
+        stop_line_positions = self.stop_line_positions
         traffic_light_distances = np.sqrt(((stop_line_positions-self.pose)**2).sum(axis=1))
         # Find the sign of the dot product of the position vector and the traffic stop line vectors wrt the previous position
         dot_product_sign = np.sign(np.dot(stop_line_positions-self.prev_pose, self.pose-self.prev_pose))
@@ -128,37 +199,91 @@ class TLDetector(object):
         nearest_light = np.amin(traffic_light_distances[np.where(traffic_light_distances>=0)[0]])
         #obtain the index for the actual traffic sign image test
         self.nearest_light_index = np.where(traffic_light_distances==nearest_light)[0][0]
-        if self.base_waypoints is None:
+        if self.stop_line_waypoints is None:
             # rospy.loginfo("THE BASE WAYPOINTS ARE NOT THERE")
             self.stopping_waypoint_index = 0
             self.stopping_waypoint_distance = 10000
             return
-        # Do the same for the waypoints. find the distance from the current position and multiply it by the sign of the dot product
-        base_waypoint_distances = np.sqrt(((self.base_waypoints-self.pose)**2).sum(axis=1))
-        waypoint_dot_product_sign = np.sign(np.dot(self.base_waypoints-self.prev_pose, self.pose-self.prev_pose))
-        base_waypoint_distances = np.multiply(base_waypoint_distances,waypoint_dot_product_sign)
-        # Find the waypoint that is smaller than, but closest to, the nearest light distance
-        self.stopping_waypoint_distance = np.amax(base_waypoint_distances[np.where(base_waypoint_distances<=nearest_light)[0]])
-        self.stopping_waypoint_index  = np.where(base_waypoint_distances==self.stopping_waypoint_distance)[0][0]
+        # The waypoint just before each stop line is fixed, so only the distance to it changes with the pose
+        self.stopping_waypoint_index = int(self.stop_line_waypoints[self.nearest_light_index])
+        # measure along the track; a car just past the stopping waypoint is still at the stop line
+        self.stopping_waypoint_distance = abs(self.track_index.distance_to(self.pose, self.stopping_waypoint_index))
         #the current position will be the previous position
         self.prev_pose = self.pose.copy()
 
     def waypoints_cb(self, msg):
-        base_waypoints = []
-        for each_waypoint in msg.waypoints:
-            base_waypoints.append([each_waypoint.pose.pose.position.x, each_waypoint.pose.pose.position.y])
-        self.base_waypoints = np.array(base_waypoints)
+        self.track_index = track_index_from_raw(msg)
+        self.base_waypoints = self.track_index.points
+        # Locate the last waypoint before every stop line once instead of on every pose update
+        self.stop_line_waypoints = self.track_index.last_before(self.stop_line_positions)
 
     def traffic_cb(self, msg):
-        self.vehicle_traffic_lights = []
-        for each_light in msg.lights:
-            self.vehicle_traffic_lights.append([each_light.pose.pose.position.x, each_light.pose.pose.position.y])
+        self.vehicle_traffic_lights = np.array([[each_light.pose.pose.position.x, each_light.pose.pose.position.y,
+                                                 each_light.pose.pose.position.z] for each_light in msg.lights])
+
+    def camera_info_cb(self, msg):
+        self.camera_intrinsics = (msg.K[0], msg.K[4], msg.K[2], msg.K[5])
+
+    def project_to_image_plane(self, point_in_world):
+        """Projects a point from world coordinates into the camera image
+
+        Args:
+            point_in_world (ndarray): x, y, z position of the point in world coordinates
+
+        Returns:
+            (float, float, float): u, v pixel coordinates and the depth of the point, None if it can not be projected
+
+        """
+        if self.camera_intrinsics is None:
+            return None
+        try:
+            trans, rot = self.listener.lookupTransform('/base_link', '/world', rospy.Time(0))
+        except (tf.LookupException, tf.ConnectivityException, tf.ExtrapolationException):
+            return None
+        # base_link has x pointing forward, y to the left and z up, the camera sits at camera_offset in it
+        point = tf.transformations.quaternion_matrix(rot)[:3, :3].dot(point_in_world) + trans - self.camera_offset
+        depth, left, up = point.dot(self.camera_forward), point[1], point.dot(self.camera_up)
+        if depth <= 0:
+            return None
+        fx, fy, cx, cy = self.camera_intrinsics
+        return fx * -left / depth + cx, fy * -up / depth + cy, depth
+
+    def get_light_roi(self, image_shape):
+        """Finds the part of the camera image around the nearest traffic light
+
+        Args:
+            image_shape (tuple): height and width of the camera image
+
+        Returns:
+            (int, int, int, int): left, right, top, bottom pixel bounds, None to use the full image
+
+        """
+        if self.nearest_light_index is None:
+            return None
+        lights = self.vehicle_traffic_lights
+        if lights is None:
+            lights = self.config_light_positions
+        if self.nearest_light_index >= len(lights):
+            return None
+        projection = self.project_to_image_plane(lights[self.nearest_light_index])
+        if projection is None:
+            return None
+        u, v, depth = projection
+        fx, fy = self.camera_intrinsics[:2]
+        half_width = max(fx * LIGHT_ROI_HALF_WIDTH / depth, MIN_ROI_HALF_SIZE)
+        half_height = max(fy * LIGHT_ROI_HALF_HEIGHT / depth, MIN_ROI_HALF_SIZE)
+        left, right = int(max(u - half_width, 0)), int(min(u + half_width, image_shape[1]))
+        top, bottom = int(max(v - half_height, 0)), int(min(v + half_height, image_shape[0]))
+        # the light projects outside the frame, so fall back to the full image
+        if right - left < MIN_ROI_HALF_SIZE or bottom - top < MIN_ROI_HALF_SIZE:
+            return None
+        return left, right, top, bottom
 
 
 
     def image_cb_function(self, msg):
-        rospy.loginfo("Image has arrived.")
-        self.c_image = msg
+        # rospy.loginfo("Image has arrived.")
+        self.frame_slot.put(msg)
 
     def image_cb(self, msg):
         if msg is None:
@@ -171,17 +296,29 @@ class TLDetector(object):
             msg (Image): image from car-mounted camera
 
         """
-        rospy.loginfo("Image Obtained.")
+        rospy.logdebug("Image Obtained.")
         self.camera_image = msg
+        # while the light can not affect braking yet, keep publishing with the last state instead of classifying
+        if self.gate_classifier and not self.classification_due():
+            self.process_traffic_lights()
+            return
         #
         #
         # The msg or self.camera_image is the image. Feed it into your model. Return the traffic light 
         # classification as the variable state (not self.state) 
         # Unknown_Light = 4, Green_Light = 2, Yellow_Light = 1, Red_Light = 0
-        cv_image = self.bridge.imgmsg_to_cv2(self.camera_image, "bgr8")
-        rospy.loginfo("Image Bridged.")
+        cv_image = self.decode_image(self.camera_image)
+        rospy.logdebug("Image Bridged.")
+        # only run the detector on the region around the expected traffic light
+        roi = self.get_light_roi(cv_image.shape) if self.use_roi else None
+        if roi is not None:
+            left, right, top, bottom = roi
+            cv_image = cv_image[top : bottom, left : right]
         state = self.light_classifier.get_classification(cv_image)
-        rospy.loginfo("Image Classified.")
+        self.last_classification_time = rospy.get_time()
+        rospy.logdebug("Image Classified.")
+        if self.debug_overlay is not None:
+            self.debug_overlay.publish(cv_image, self.light_classifier.last_detections)
 
         '''
         Publish upcoming red lights at camera frequency.
@@ -197,7 +334,35 @@ class TLDetector(object):
         self.state_count += 1
         # implement the process traffic lights function
         self.process_traffic_lights()
-        rospy.loginfo("Image Processed.")
+        rospy.logdebug("Image Processed. Frames dropped: " + str(self.frame_slot.dropped))
+
+    def get_stop_distances(self):
+        """Returns the minimum and maximum distances the car needs to stop from its current velocity"""
+        #obtain the minimum stopping distance possible given the acceleration, and jerk limits, and slow stop point
+        acceleration_limit = 10.0 - 1.0
+        slow_stop_point = 0
+        min_stop_distance = .2*self.current_velocity + (self.current_velocity*(self.current_velocity-slow_stop_point)/acceleration_limit - acceleration_limit/2.0*((self.current_velocity-slow_stop_point)/acceleration_limit)**2) + (0.5*slow_stop_point**2)
+        #obtain the maximum stopping distance by changing the acceleration limit to 6
+        acceleration_limit -= 3.0
+        max_stop_distance = .2*self.current_velocity + (self.current_velocity*(self.current_velocity-slow_stop_point)/acceleration_limit - acceleration_limit/2.0*((self.current_velocity-slow_stop_point)/acceleration_limit)**2) + (0.5*slow_stop_point**2)
+        #add on the current_velocity*rate to make sure it does not overlook the time gap
+        max_stop_distance += self.current_velocity*1.0/self.loop_rate
+        return min_stop_distance, max_stop_distance
+
+    def classification_due(self):
+        # inside braking range every frame is classified
+        slack = self.stopping_waypoint_distance - self.get_stop_distances()[1]
+        if slack <= 0:
+            return True
+        # further out, classify often enough to have a state before the car reaches braking range
+        period = min(slack / max(self.current_velocity, 1.0) / 2.0, MAX_CLASSIFY_PERIOD)
+        return rospy.get_time() - self.last_classification_time >= period
+
+    def decode_image(self, msg):
+        # compressed frames carry the simulator JPEG, which OpenCV decodes to BGR directly
+        if isinstance(msg, CompressedImage):
+            return cv2.imdecode(np.frombuffer(msg.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return self.bridge.imgmsg_to_cv2(msg, "bgr8")
 
     def process_traffic_lights(self):
         """Finds closest visible traffic light, if one exists, and determines its
@@ -212,15 +377,8 @@ class TLDetector(object):
         nearest_light = self.stopping_waypoint_distance
         # the result of the image_cb function is in the equation below
         traffic_light_value = self.last_state
-        #obtain the minimum stopping distance possible given the acceleration, and jerk limits, and slow stop point
-        acceleration_limit = 10.0 - 1.0
         slow_stop_point = 0
-        min_stop_distance = .2*self.current_velocity + (self.current_velocity*(self.current_velocity-slow_stop_point)/acceleration_limit - acceleration_limit/2.0*((self.current_velocity-slow_stop_point)/acceleration_limit)**2) + (0.5*slow_stop_point**2)
-        #obtain the maximum stopping distance by changing the acceleration limit to 6
-        acceleration_limit -= 3.0
-        max_stop_distance = .2*self.current_velocity + (self.current_velocity*(self.current_velocity-slow_stop_point)/acceleration_limit - acceleration_limit/2.0*((self.current_velocity-slow_stop_point)/acceleration_limit)**2) + (0.5*slow_stop_point**2)
-        #add on the current_velocity*rate to make sure it does not overlook the time gap
-        max_stop_distance += self.current_velocity*1.0/self.loop_rate
+        min_stop_distance, max_stop_distance = self.get_stop_distances()
         #If the velocity is less than 2*slow_stop_point and the distance to the light is less than 2*(0.5*slow_stop_point**2) and the light is red
         if (self.current_velocity<=2*slow_stop_point and nearest_light<=slow_stop_point**2 and traffic_light_value==self.Red_Light):
             None
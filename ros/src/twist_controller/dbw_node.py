@@ -2,14 +2,15 @@
 
 import rospy
 from std_msgs.msg import Bool, Float64, Int32
-from styx_msgs.msg import Lane
 from dbw_mkz_msgs.msg import ThrottleCmd, SteeringCmd, BrakeCmd, SteeringReport
 from geometry_msgs.msg import TwistStamped, PoseStamped
 import math
 import numpy as np
 
 from twist_controller import Controller
-from pid import PID
+from pid import PID, RingBufferPID, MIN_NUM, MAX_NUM
+from loop_monitor import LoopMonitor
+from waypoint_lib import SegmentTracker, track_index_from_raw
 
 '''
 You can build this node only after you have built (or partially built) the `waypoint_updater` node.
@@ -34,6 +35,11 @@ that we have created in the `__init__` function.
 
 '''
 
+MIN_STOP_DISTANCE = 1.0 # metres. Keeps the braking rate finite once the car reaches the stopping waypoint
+CURVATURE_SPACING = 5 # waypoints between the three points whose circle gives the track curvature
+MAX_CTE_STEER = 8. # limit of the steering correction from the cross track error, applied inside its PID
+PID_TYPES = {'average': PID, 'ring': RingBufferPID} # selectable per controller with the ~cte_pid and ~angle_pid params
+
 class DBWNode(object):
     def __init__(self):
         rospy.init_node('dbw_node')
@@ -62,11 +68,12 @@ class DBWNode(object):
         self.angular_velocity = 0
         self.steer_direction = 0
         self.base_waypoints = None
+        self.track_index = None
+        self.track_curvature = None
+        self.track_heading = None
+        self.segment_tracker = None
         self.prev_position = None
         self.prev_msg = np.array([-1 , -1])
-        self.prev_midpoint = None
-        self.prev_prev_midpoint = None
-        self.two_closest_points = None
         self.prev_light_msg = -1
         self.light_msg = -1
         self.drive_model = -1
@@ -76,9 +83,20 @@ class DBWNode(object):
         ki = 0.0 # kp=0.3, ki=0.0, kd=0.57
         kd = 0.0
         self.c_position = None
-        self.pid_controller_cte = PID(kp, ki, kd)
-        self.pid_controller_angle = PID(kp, ki, kd)
-        self.base_waypoints_sub = rospy.Subscriber('/base_waypoints', Lane, self.waypoints_cb)
+        # control cycles run at loop_rate, or on every new pose once the node is up if trigger_on_pose is set
+        self.loop_rate = rospy.get_param('~loop_rate', 50)
+        # the PID clamps its own output, so the ring buffer PID sees the saturation and stops integrating
+        self.pid_controller_cte = self.create_pid(rospy.get_param('~cte_pid', 'ring'), kp, ki, kd,
+                                                  rospy.get_param('~cte_derivative_tau', 0.),
+                                                  -MAX_CTE_STEER, MAX_CTE_STEER)
+        self.pid_controller_angle = self.create_pid(rospy.get_param('~angle_pid', 'ring'), kp, ki, kd)
+        self.trigger_on_pose = False
+        self.loop_monitor = LoopMonitor(1.0/self.loop_rate)
+        self.overruns_pub = rospy.Publisher('~overruns', Int32, queue_size=1)
+        self.jitter_pub = rospy.Publisher('~jitter', Float64, queue_size=1)
+        self.cycle_time_pub = rospy.Publisher('~cycle_time', Float64, queue_size=1)
+        # received raw, so the lane is only deserialized when the loader's shared track cannot be attached
+        self.base_waypoints_sub = rospy.Subscriber('/base_waypoints', rospy.AnyMsg, self.waypoints_cb)
         self.current_velocity_sub = rospy.Subscriber('/current_velocity', TwistStamped, self.current_velocity_function)
         # self.cte_sub = rospy.Subscriber('/cross_track_error',Float64, self.cte_function)
         #self.twist_cmd_sub = rospy.Subscriber('/twist_cmd', TwistStamped, self.twist_cmd_function)
@@ -101,45 +119,76 @@ class DBWNode(object):
         self.brake_pub = rospy.Publisher('/vehicle/brake_cmd',
                                          BrakeCmd, queue_size=1)
 
-        self.loop_rate = 5
-        self.loop() 
-        # rospy.spin()
+        if rospy.get_param('~trigger_on_pose', False):
+            self.trigger_on_pose = True
+            rospy.spin()
+        else:
+            self.loop()
 
     def loop(self):
-        rate = rospy.Rate(self.loop_rate) # 1Hz
+        rate = rospy.Rate(self.loop_rate)
         while not rospy.is_shutdown():
-            self.pose_cb(self.c_position)
+            self.control_cycle(self.c_position)
             rate.sleep()
+
+    def control_cycle(self, msg):
+        start = self.loop_monitor.start()
+        self.pose_cb(msg)
+        self.loop_monitor.stop(start)
+        # report about once a second
+        if self.loop_monitor.cycles >= self.loop_rate:
+            self.publish_loop_stats()
+
+    def publish_loop_stats(self):
+        monitor = self.loop_monitor
+        if monitor.overruns:
+            rospy.logwarn("%d of %d control cycles overran their %.1f ms deadline", monitor.overruns, monitor.cycles, 1000.*monitor.period)
+        self.overruns_pub.publish(Int32(monitor.total_overruns))
+        self.jitter_pub.publish(Float64(monitor.jitter()))
+        self.cycle_time_pub.publish(Float64(monitor.max_compute_time))
+        monitor.reset()
     
+    def create_pid(self, pid_type, kp, ki, kd, derivative_tau=0., mn=MIN_NUM, mx=MAX_NUM):
+        if pid_type not in PID_TYPES:
+            rospy.logwarn("Unknown PID type %s, using ring", pid_type)
+            pid_type = 'ring'
+        if pid_type == 'ring':
+            return RingBufferPID(kp, ki, kd, mn, mx, derivative_tau=derivative_tau, sample_time=1.0/self.loop_rate)
+        return PID_TYPES[pid_type](kp, ki, kd, mn, mx)
+
     def kmph2mps(self, velocity_kmph):
         return (velocity_kmph * 1000.) / (60. * 60.)
 
     def waypoints_cb(self, waypoints):
-        # TODO: Implement
         # rospy.loginfo("Oncoming Waypoints are loading")
-        self.base_waypoints = []
-        for waypoint in waypoints.waypoints:
-            # add to the waypoints list
-            self.base_waypoints.append([waypoint.pose.pose.position.x, waypoint.pose.pose.position.y])
-        self.base_waypoints = np.array(self.base_waypoints)
+        track_index = track_index_from_raw(waypoints)
+        # the steering feed-forward is looked up by waypoint index, so the geometry is computed once here
+        self.track_curvature = track_index.curvature(CURVATURE_SPACING)
+        self.track_heading = track_index.heading()
+        self.base_waypoints = track_index.points
+        # the tracker takes its segment directions from the precomputed heading
+        self.segment_tracker = SegmentTracker(track_index, self.track_heading)
+        self.track_index = track_index
         # rospy.loginfo("The number of oncoming waypoints are: " + str(self.base_waypoints.shape))
 
     def pose_cb_function(self, msg):
         self.c_position = msg
+        if self.trigger_on_pose:
+            self.control_cycle(msg)
 
     def pose_cb(self, msg):
         if msg is None:
             return
-        if self.base_waypoints is None:
+        if self.track_index is None:
             return
-        rospy.loginfo("Position is updated: " + str(msg.pose.position.x) + "," + str(msg.pose.position.y))
+        rospy.logdebug("Position is updated: " + str(msg.pose.position.x) + "," + str(msg.pose.position.y))
         msg = np.array([msg.pose.position.x, msg.pose.position.y])
         if msg[0]==self.prev_msg[0] and msg[1]==self.prev_msg[1]:
             return
-        #Find the closest two waypoints given the position.
+        #Find the track segment under the car given the position.
         self.steer = 0
         if self.prev_sample_time is None:
-            self.sample_time = 0.2
+            self.sample_time = 1.0/self.loop_rate
             self.prev_sample_time = rospy.get_time()
         else:
             time = rospy.get_time()
@@ -149,72 +198,18 @@ class DBWNode(object):
         if self.base_waypoints is not None:
             if msg[0]==self.prev_msg[0] and msg[1]==self.prev_msg[1]:
                 return
-            #the distances from the current position for all waypoints
-            wp_distances = ((self.base_waypoints-msg)**2).sum(axis=1)
-            #find and append the closest, fourth, and eighth point
-            circle_points = self.base_waypoints[np.argmin(wp_distances)]
-            # rospy.loginfo("circle_points: " + str(circle_points))
-            circle_points = np.vstack((circle_points, self.base_waypoints[(np.argmin(wp_distances)+5)%len(wp_distances)]))
-            # rospy.loginfo("circle_points: " + str(circle_points.shape))
-            circle_points = np.vstack((circle_points, self.base_waypoints[(np.argmin(wp_distances)+10)%len(wp_distances)]))
-            # rospy.loginfo("circle_points: " + str(circle_points.shape))
-            #use the three points to find the radius of the circle
-            eval_matrix = np.vstack((-2*circle_points[:,0],-2*circle_points[:,1],(circle_points**2).sum(axis=1))).T
-            # rospy.loginfo("eval_matrix: " + str(eval_matrix.shape))
-            #subtract the last entry of the eval matrix from the others and keep the first two rows
-            eval_matrix = np.subtract(eval_matrix,eval_matrix[2])[0:2]
-            try:
-                x = np.linalg.solve(eval_matrix[:,0:2],eval_matrix[:,2])
-                # rospy.loginfo("X obtained: " + str(x))
-                radius = (((msg-x)**2).sum()*1.0)**(1.0/2)
-                # rospy.loginfo("Radius: " + str(radius))
-                #convert the angle into degrees then divide by the steering ratio to get the steer value
-                angle = np.arcsin(self.wheel_base/radius) #* (180.0/np.pi)
-                steer_value = angle * self.steer_ratio
-            except:
-                steer_value = 0
-            #the sign of the steer value depends on the slope from the first to the last point
-            two_closest_points = self.base_waypoints[np.sort(wp_distances.argsort()[:2])].copy()
-            # make sure the waypoints are in the correct order by comparing their distance from the previous midpoint
-            # keep the last two midpoints
-            if self.prev_midpoint is None:
-                self.two_closest_points = two_closest_points.copy()
-                self.prev_midpoint = np.divide(np.add(two_closest_points[0],two_closest_points[1]),2.0).copy()
-                self.prev_prev_midpoint = self.prev_midpoint.copy()
-            elif np.all(self.prev_midpoint==np.divide(np.add(two_closest_points[0],two_closest_points[1]),2.0)):
-                two_closest_points = self.two_closest_points.copy()
-            else:
-                #if the midpoints are not equal, sort by proximity to the previous midpoint
-                # rospy.loginfo("Closest points may change: " + str(two_closest_points[0][0]) + "," + str(two_closest_points[0][1]))
-                # rospy.loginfo("Closest points may change: " + str(two_closest_points[1][0]) + "," + str(two_closest_points[1][1]))
-                self.two_closest_points = two_closest_points[((two_closest_points-self.prev_midpoint)**2).sum(axis=1).argsort()].copy()
-                two_closest_points = self.two_closest_points.copy()
-                self.prev_prev_midpoint = self.prev_midpoint.copy()
-                self.prev_midpoint = np.divide(np.add(two_closest_points[0],two_closest_points[1]),2.0).copy()
-            # rospy.loginfo("Closest points: " + str(two_closest_points[0][0]) + "," + str(two_closest_points[0][1]))
-            # rospy.loginfo("Closest points: " + str(two_closest_points[1][0]) + "," + str(two_closest_points[1][1]))
-            # get the direction for the steer value
-            if (np.cross(two_closest_points[0]-self.prev_prev_midpoint,circle_points[2]-self.prev_prev_midpoint)<0):
-                steer_value *= -1
-            if np.all(self.prev_prev_midpoint == self.prev_midpoint):
-                steer_value *= -1
-            self.cte = abs(np.linalg.norm(np.cross(two_closest_points[0]-two_closest_points[1], two_closest_points[1]-msg))/np.linalg.norm(two_closest_points[0]-two_closest_points[1]))
-            # rospy.loginfo("The CTE: " + str(self.cte))
-            #the cross product will determine the direction. if the cross product is positive, the the car is to the left, cte is negative
-            # rospy.loginfo("two_closest_points[0]-self.prev_prev_midpoint: " + str(two_closest_points[0]-self.prev_prev_midpoint))
-            # rospy.loginfo("msg-self.prev_prev_midpoint: " + str(msg-self.prev_prev_midpoint))
-            # rospy.loginfo("self.prev_prev_midpoint: " + str(self.prev_prev_midpoint))
-            # rospy.loginfo("np.cross: " + str(np.cross(two_closest_points[0]-self.prev_prev_midpoint,msg-self.prev_prev_midpoint)))
-            if (np.cross(two_closest_points[0]-self.prev_prev_midpoint,msg-self.prev_prev_midpoint)>0):
-                self.cte *= -1
-            if np.all(self.prev_prev_midpoint == self.prev_midpoint):
-                self.cte *= -1
-            # if ((course_midpoint-msg)**2).sum() < ((course_midpoint-self.prev_midpoint)**2).sum():
-            # rospy.loginfo("The CTE: " + str(self.cte))
+            #follow the track segment under the car, checking only its neighbours on each cycle
+            segment = self.segment_tracker.update(msg)
+            #the curvature of the circle through the segment start, fifth and tenth waypoint is precomputed for the whole track
+            #its sign gives the steering direction, positive to the left
+            angle = math.asin(max(min(self.wheel_base*self.track_curvature[segment], 1.), -1.))
+            steer_value = angle * self.steer_ratio
+            #the distance to the segment line, negative when the car is to its left
+            self.cte = self.segment_tracker.cte(msg, segment)
             kp_cte = 0.25#0.1 - .05*self.current_velocity/self.maximum_velocity###07 best is 0.31, .41
             ki_cte = 0.0#16#.08 # 1.015
             kd_cte = 0.5#0.25 + .20*self.current_velocity/self.maximum_velocity#5#.35 # 0.5
-            pid_step_cte = max(min(self.pid_controller_cte.step(self.cte, self.sample_time, kp_cte, ki_cte, kd_cte), 8), -8)
+            pid_step_cte = self.pid_controller_cte.step(self.cte, self.sample_time, kp_cte, ki_cte, kd_cte)
             self.prev_msg = msg
             # rospy.loginfo("The steer value: " + str(steer_value))
             # rospy.loginfo("The PID CTE: " + str(pid_step_cte))
@@ -233,7 +228,9 @@ class DBWNode(object):
                     throttle, brake = min(.42,self.current_velocity*.1/5.36 + .15), 0
             elif self.drive_model >= 0:
                 #brake at a deceleration rate of current_velocity**2/(2*distance)
-                wp_2_pos = ((msg-self.base_waypoints[self.drive_model])**2).sum() - self.current_velocity*1.0/self.loop_rate
+                #the distance to the stopping waypoint is measured along the track
+                wp_2_pos = self.track_index.distance_to(msg, self.drive_model) - self.current_velocity*1.0/self.loop_rate
+                wp_2_pos = max(wp_2_pos, MIN_STOP_DISTANCE)
                 brake_rate = self.current_velocity**2/(2*wp_2_pos)
                 throttle, brake = 0, self.vehicle_mass*brake_rate*self.wheel_radius
                 if self.current_velocity<5:
@@ -243,7 +240,7 @@ class DBWNode(object):
             if self.dbw_enabled_bool:
                 # rospy.loginfo("The steer: " + str(steer_value+pid_step_cte))
                 self.publish(throttle=throttle, brake=brake, steer=steer_value+pid_step_cte)
-                rospy.loginfo("The controls published: " + str(brake))
+                rospy.logdebug("The controls published: " + str(brake))
     
     def traffic_cb(self, msg):
         #choose the model, depending upon the msg
@@ -0,0 +1,49 @@
+import math
+import time
+
+
+class LoopMonitor(object):
+    """Times control cycles against their deadline.
+
+    Counts the cycles whose compute time overran the period and keeps the spread of
+    the intervals between cycle starts, which is the jitter of the schedule.
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.total_overruns = 0
+        self.last_start = None
+        self.reset()
+
+    def reset(self):
+        self.cycles = 0
+        self.overruns = 0
+        self.max_compute_time = 0.
+        self.intervals = 0
+        self.interval_sum = 0.
+        self.interval_sq_sum = 0.
+
+    def start(self):
+        start = time.time()
+        if self.last_start is not None:
+            interval = start - self.last_start
+            self.intervals += 1
+            self.interval_sum += interval
+            self.interval_sq_sum += interval * interval
+        self.last_start = start
+        return start
+
+    def stop(self, start):
+        compute_time = time.time() - start
+        self.cycles += 1
+        if compute_time > self.period:
+            self.overruns += 1
+            self.total_overruns += 1
+        self.max_compute_time = max(self.max_compute_time, compute_time)
+
+    def jitter(self):
+        """Returns the standard deviation in seconds of the intervals between cycle starts since the last reset"""
+        if self.intervals < 2:
+            return 0.
+        mean = self.interval_sum / self.intervals
+        return math.sqrt(max(self.interval_sq_sum / self.intervals - mean * mean, 0.))
@@ -1,8 +1,12 @@
 from collections import deque
 import numpy as np
 
+from lowpass import LowPassFilter
+
 MIN_NUM = float('-inf')
 MAX_NUM = float('inf')
+# Number of recent error samples averaged by the integral term
+INTEGRAL_WINDOW = 8
 
 
 class PID(object):
@@ -37,3 +41,60 @@ class PID(object):
         self.last_error = error
 
         return val
+
+
+class RingBufferPID(object):
+    """PID whose integral term averages the last `window` error samples, like PID.
+
+    The samples are kept in a fixed ring buffer with a running sum, so a step takes
+    constant time without calling NumPy. A sample that would push an output already
+    at its limit further is not integrated, and the derivative goes through a
+    LowPassFilter, which passes it unchanged with the default derivative_tau of 0.
+    """
+
+    def __init__(self, kp, ki, kd, mn=MIN_NUM, mx=MAX_NUM, window=INTEGRAL_WINDOW, derivative_tau=0., sample_time=1.):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.min = mn
+        self.max = mx
+        self.window = window
+        self.derivative_tau = derivative_tau
+        self.sample_time = sample_time
+        self.reset()
+
+    def reset(self):
+        self.samples = [0.] * self.window
+        self.head = 0
+        self.count = 0
+        self.int_sum = 0.
+        self.last_error = 0.
+        self.derivative_filter = LowPassFilter(self.derivative_tau, self.sample_time)
+
+    def step(self, error, sample_time, kp, ki, kd):
+        sample = error * sample_time
+        # the sample replaces the oldest one once the buffer is full
+        int_sum = self.int_sum + sample - self.samples[self.head]
+        count = min(self.count + 1, self.window)
+        derivative = self.derivative_filter.filt((error - self.last_error) / sample_time)
+
+        val = kp * error + ki * int_sum / count + kd * derivative
+
+        windup = False
+        if val > self.max:
+            val = self.max
+            windup = sample > 0
+        elif val < self.min:
+            val = self.min
+            windup = sample < 0
+        if not windup:
+            self.samples[self.head] = sample
+            self.head = (self.head + 1) % self.window
+            self.count = count
+            self.int_sum = int_sum
+            # resum once per lap of the buffer so rounding errors cannot build up
+            if self.head == 0:
+                self.int_sum = sum(self.samples)
+        self.last_error = error
+
+        return val
@@ -0,0 +1,5 @@
+from .track_index import TrackIndex, lane_to_array
+from .velocity_planner import VelocityPlanner
+from .shared_track import save_array_atomic, export_track, withdraw_track, attach_track, track_index_from_raw
+from .segment_tracker import SegmentTracker
+from .latest_frame import LatestFrame
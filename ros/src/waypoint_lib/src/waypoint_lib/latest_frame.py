@@ -0,0 +1,49 @@
+import threading
+
+import rospy
+
+
+class LatestFrame(object):
+    """Size-1 frame slot shared by a camera callback and a worker thread.
+
+    A new frame replaces the one waiting in the slot, so the worker always gets the
+    freshest image and stale frames are dropped instead of queued.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, frame):
+        with self.condition:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.condition.notify()
+
+    def take(self):
+        # blocks until a frame arrives, returns None once the slot is closed
+        with self.condition:
+            while self.frame is None and not self.closed:
+                self.condition.wait()
+            frame, self.frame = self.frame, None
+            return frame
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def serve(self, handle, name):
+        """Passes each frame taken from the slot to `handle` until the slot is closed"""
+        while True:
+            frame = self.take()
+            if frame is None:
+                return
+            # a bad frame must not end the worker, frames would silently stop being handled
+            try:
+                handle(frame)
+            except Exception as e:
+                rospy.logerr('%s failed on a frame: %s', name, e)
@@ -0,0 +1,87 @@
+import math
+
+import numpy as np
+
+
+class SegmentTracker(object):
+    """Follows the track segment the car is on.
+
+    Segment i runs from waypoint i to waypoint i + 1, wrapping at the end of the track.
+    Each update projects the car onto the current segment and steps to a neighbour while
+    the projection falls outside it, so a cycle only looks at a few segments. The track
+    index is only asked again when the car is not found within its search window.
+
+    Segment directions come from `heading`, as precomputed by TrackIndex.heading, which
+    is computed here when not given.
+    """
+
+    def __init__(self, track_index, heading=None):
+        self.track_index = track_index
+        self.points = track_index.points
+        self.num_points = track_index.num_points
+        self.max_steps = max(track_index.window, 1)
+        self.heading = track_index.heading() if heading is None else heading
+        self.lengths = np.sqrt(((np.roll(self.points, -1, axis=0) - self.points)**2).sum(axis=1))
+        self.segment = None
+
+    def projection(self, segment, position):
+        """Returns where `position` projects onto `segment`, 0 at its start and 1 at its end"""
+        length = self.lengths[segment]
+        if length == 0.:
+            # a repeated waypoint, always stepped over
+            return float('inf')
+        heading = self.heading[segment]
+        offset = position - self.points[segment]
+        return (offset[0]*math.cos(heading) + offset[1]*math.sin(heading)) / length
+
+    def seek(self, position, segment):
+        """Steps from `segment` to the one `position` projects onto, None if that takes more than max_steps"""
+        t = self.projection(segment, position)
+        steps = 0
+        while t > 1. and steps < self.max_steps:
+            segment = (segment + 1) % self.num_points
+            t = self.projection(segment, position)
+            steps += 1
+        if t > 1.:
+            return None
+        if steps > 0:
+            # only step back when the car did not move forward, so an outside corner cannot bounce between two segments
+            return segment
+        previous = segment
+        while t < 0.:
+            previous = (previous - 1) % self.num_points
+            steps += 1
+            if steps == self.max_steps:
+                return None
+            if self.lengths[previous] == 0.:
+                continue
+            previous_t = self.projection(previous, position)
+            # past the end of the previous segment and before the start of this one, the car is in a corner
+            if previous_t > 1.:
+                break
+            segment, t = previous, previous_t
+        return segment
+
+    def update(self, position):
+        """Returns the index of the segment under `position` (x, y)"""
+        position = np.asarray(position, dtype=np.float64)[:2]
+        segment = None
+        if self.segment is not None:
+            segment = self.seek(position, self.segment)
+        if segment is None:
+            segment = self.seek(position, (self.track_index.closest(position) - 1) % self.num_points)
+            if segment is None:
+                segment = self.track_index.closest(position)
+        self.segment = segment
+        return segment
+
+    def cte(self, position, segment=None):
+        """Returns the cross track error of `position` to the line of `segment`, negative when the car is left of it"""
+        if segment is None:
+            segment = self.segment
+        position = np.asarray(position, dtype=np.float64)[:2]
+        offset = position - self.points[segment]
+        if self.lengths[segment] == 0.:
+            return -np.sqrt((offset**2).sum())
+        heading = self.heading[segment]
+        return -(math.cos(heading)*offset[1] - math.sin(heading)*offset[0])
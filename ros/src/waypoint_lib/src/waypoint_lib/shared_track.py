@@ -0,0 +1,96 @@
+import os
+import socket
+import struct
+import tempfile
+
+import numpy as np
+import rospy
+from styx_msgs.msg import Lane
+
+from .track_index import TrackIndex
+
+# Parameter through which the waypoint loader advertises the exported track
+SHARED_TRACK_PARAM = '/base_waypoints_shared'
+# Columns of the exported track
+SHARED_TRACK_COLUMNS = ['x', 'y', 'z', 'velocity']
+
+
+def save_array_atomic(path, array):
+    """Saves `array` to the .npy file `path`, creating its directory if needed"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # write next to the target and rename, so a reader never sees half a file
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False) as tmp:
+        np.save(tmp, array)
+    os.rename(tmp.name, path)
+
+
+def export_track(path, track, stamp):
+    """Writes the (N, len(SHARED_TRACK_COLUMNS)) `track` array to `path` and advertises it.
+
+    Nodes on the same host memory-map the file, so the raw track is held once in the page
+    cache instead of being deserialized by every node; each node still builds its own
+    index over it. On /dev/shm the file never touches the disk. `stamp` is the header
+    stamp of the /base_waypoints lane carrying the same track, which nodes check before
+    attaching.
+    """
+    save_array_atomic(path, np.asarray(track, dtype=np.float64))
+    rospy.set_param(SHARED_TRACK_PARAM, {'host': socket.gethostname(), 'path': path, 'size': len(track),
+                                         'stamp': [stamp.secs, stamp.nsecs]})
+
+
+def withdraw_track(path=None):
+    """Removes an exported track, by default the one currently advertised on this host"""
+    info = rospy.get_param(SHARED_TRACK_PARAM, None)
+    if path is None and info and info.get('host') == socket.gethostname():
+        path = info.get('path')
+    try:
+        rospy.delete_param(SHARED_TRACK_PARAM)
+    except KeyError:
+        pass
+    if path and os.path.isfile(path):
+        os.remove(path)
+
+
+def raw_lane_identity(buff):
+    """Returns the (secs, nsecs) header stamp and the waypoint count of a serialized styx_msgs/Lane"""
+    # the header is seq, stamp secs and nsecs, then frame_id as a length prefixed string
+    _, secs, nsecs, frame_id_length = struct.unpack_from('<4I', buff, 0)
+    count, = struct.unpack_from('<I', buff, 16 + frame_id_length)
+    return (secs, nsecs), count
+
+
+def attach_track(size, stamp):
+    """Returns the exported track memory-mapped read-only.
+
+    Returns None unless the track was exported on this host for the lane with `size`
+    waypoints and the (secs, nsecs) header `stamp`.
+    """
+    info = rospy.get_param(SHARED_TRACK_PARAM, None)
+    if not info or info.get('host') != socket.gethostname():
+        return None
+    if info.get('size') != size or tuple(info.get('stamp', ())) != tuple(stamp):
+        rospy.logwarn('Ignoring the shared track %s, it does not belong to the received lane', info.get('path'))
+        return None
+    try:
+        track = np.load(info['path'], mmap_mode='r')
+    except (IOError, OSError, ValueError) as e:
+        rospy.logwarn('Could not attach to the shared track %s: %s', info['path'], e)
+        return None
+    if track.shape != (size, len(SHARED_TRACK_COLUMNS)):
+        rospy.logwarn('Ignoring the shared track %s with shape %s', info['path'], track.shape)
+        return None
+    return track
+
+
+def track_index_from_raw(msg):
+    """Builds the TrackIndex of a /base_waypoints message received as rospy.AnyMsg.
+
+    The message is only deserialized when the shared track cannot be attached.
+    """
+    stamp, size = raw_lane_identity(msg._buff)
+    track = attach_track(size, stamp)
+    if track is not None:
+        return TrackIndex(track[:, :3])
+    return TrackIndex.from_lane(Lane().deserialize(msg._buff))
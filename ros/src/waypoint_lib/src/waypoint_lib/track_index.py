@@ -0,0 +1,116 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Number of waypoints searched on either side of the last match before falling back to the tree
+SEARCH_WINDOW = 50
+
+
+def lane_to_array(lane, with_z=False):
+    """Converts the waypoints of a styx_msgs/Lane into an (N, 2) array of x, y positions, or (N, 3) with z"""
+    if with_z:
+        return np.array([[wp.pose.pose.position.x, wp.pose.pose.position.y, wp.pose.pose.position.z]
+                         for wp in lane.waypoints])
+    return np.array([[wp.pose.pose.position.x, wp.pose.pose.position.y] for wp in lane.waypoints])
+
+
+class TrackIndex(object):
+    """Nearest-waypoint lookup over an ordered track.
+
+    The KD-tree is built once when the base waypoints arrive. Consecutive queries are
+    answered by searching a small window around the previous match, which is O(1) while
+    the car follows the track, and fall back to the O(log N) tree query otherwise.
+
+    The cumulative arc length along the track is also computed once, so the along-track
+    distance between any two waypoints is a subtraction. The track is treated as a loop
+    closed by the segment from the last waypoint back to the first.
+    """
+
+    def __init__(self, points, window=SEARCH_WINDOW):
+        points = np.asarray(points, dtype=np.float64)
+        self.points = np.ascontiguousarray(points[:, :2])
+        self.num_points = len(self.points)
+        self.window = min(window, (self.num_points - 1) // 2)
+        self.tree = cKDTree(self.points)
+        self.last_index = None
+        # arc_length[i] is the distance along the track from the first waypoint to waypoint i
+        segments = np.sqrt((np.diff(points, axis=0)**2).sum(axis=1))
+        self.arc_length = np.concatenate(([0.], np.cumsum(segments)))
+        self.track_length = self.arc_length[-1] + np.sqrt(((points[0] - points[-1])**2).sum())
+
+    @classmethod
+    def from_lane(cls, lane, window=SEARCH_WINDOW):
+        return cls(lane_to_array(lane, with_z=True), window)
+
+    def closest(self, position):
+        """Returns the index of the waypoint closest to `position` (x, y)"""
+        position = np.asarray(position, dtype=np.float64)[:2]
+        if self.last_index is not None and self.window > 0:
+            indices = np.arange(self.last_index - self.window, self.last_index + self.window + 1) % self.num_points
+            offset = np.argmin(((self.points[indices] - position)**2).sum(axis=1))
+            # a match on the window border means the car may have left it, so ask the tree
+            if 0 < offset < 2*self.window:
+                self.last_index = int(indices[offset])
+                return self.last_index
+        self.last_index = int(self.tree.query(position)[1])
+        return self.last_index
+
+    def closest_ahead(self, position):
+        """Returns the index of the first waypoint in front of `position` along the track order"""
+        position = np.asarray(position, dtype=np.float64)[:2]
+        index = self.closest(position)
+        next_index = (index + 1) % self.num_points
+        # the closest waypoint is behind the car if the car lies past it along the segment direction
+        if np.dot(self.points[next_index] - self.points[index], position - self.points[index]) > 0:
+            return next_index
+        return index
+
+    def distance(self, wp1, wp2):
+        """Returns the distance along the track from waypoint `wp1` forward to waypoint `wp2`.
+
+        Either argument may be an array of indices. When `wp2` comes before `wp1` the
+        distance wraps around the end of the loop.
+        """
+        dist = self.arc_length[wp2] - self.arc_length[wp1]
+        return np.where(dist < 0, dist + self.track_length, dist)
+
+    def distance_to(self, position, index):
+        """Returns the along-track distance from `position` to waypoint `index`.
+
+        The result is negative when the waypoint is less than half a lap behind the car.
+        """
+        position = np.asarray(position, dtype=np.float64)[:2]
+        ahead = self.closest_ahead(position)
+        dist = float(self.distance(ahead, index)) + np.sqrt(((self.points[ahead] - position)**2).sum())
+        if dist > self.track_length / 2.:
+            dist -= self.track_length
+        return dist
+
+    def last_before(self, positions):
+        """Returns, for each position, the index of the last waypoint that is not past it.
+
+        Leaves the windowed search state alone, so it suits static features such as stop lines.
+        """
+        positions = np.atleast_2d(np.asarray(positions, dtype=np.float64))[:, :2]
+        indices = self.tree.query(positions)[1]
+        next_indices = (indices + 1) % self.num_points
+        past = ((self.points[indices] - positions) * (self.points[next_indices] - self.points[indices])).sum(axis=1) > 0
+        return np.where(past, (indices - 1) % self.num_points, indices)
+
+    def curvature(self, spacing=1):
+        """Returns the signed curvature at every waypoint, positive where the track turns left.
+
+        The curvature at waypoint i is that of the circle through waypoints i, i + spacing
+        and i + 2*spacing, and zero where they are collinear.
+        """
+        a = self.points
+        b = np.roll(a, -spacing, axis=0)
+        c = np.roll(a, -2*spacing, axis=0)
+        ab, bc, ac = b - a, c - b, c - a
+        cross = ab[:, 0]*ac[:, 1] - ab[:, 1]*ac[:, 0]
+        lengths = np.sqrt((ab**2).sum(axis=1) * (bc**2).sum(axis=1) * (ac**2).sum(axis=1))
+        return np.where(lengths > 0, 2.*cross / np.where(lengths > 0, lengths, 1.), 0.)
+
+    def heading(self):
+        """Returns the direction in radians of the segment from every waypoint to the next one"""
+        tangent = np.roll(self.points, -1, axis=0) - self.points
+        return np.arctan2(tangent[:, 1], tangent[:, 0])
@@ -0,0 +1,50 @@
+import numpy as np
+
+
+class VelocityPlanner(object):
+    """Computes speed limits along a stretch of track in one vectorized pass.
+
+    Speeds are capped by the target velocity of each waypoint, by how fast the car can
+    accelerate from its current speed, and, when a stop is requested, by a jerk-limited
+    braking envelope that brings the car to rest at the stop distance.
+    """
+
+    def __init__(self, max_acceleration, max_deceleration, max_jerk):
+        self.max_acceleration = max_acceleration
+        self.max_deceleration = max_deceleration
+        self.max_jerk = max_jerk
+        # while the deceleration ramps up at max_jerk the car covers ramp_distance and sheds ramp_velocity
+        self.ramp_time = max_deceleration / max_jerk
+        self.ramp_velocity = max_jerk * self.ramp_time**2 / 2.
+        self.ramp_distance = max_jerk * self.ramp_time**3 / 6.
+
+    def braking_envelope(self, remaining):
+        """Returns the highest speed from which the car can stop within each `remaining` distance"""
+        remaining = np.maximum(np.asarray(remaining, dtype=np.float64), 0.)
+        velocity = np.empty_like(remaining)
+        # run the stop backwards in time: deceleration grows at max_jerk, then holds at max_deceleration
+        ramp = remaining <= self.ramp_distance
+        velocity[ramp] = self.max_jerk / 2. * (6. * remaining[ramp] / self.max_jerk)**(2. / 3.)
+        extra = remaining[~ramp] - self.ramp_distance
+        velocity[~ramp] = np.sqrt(self.ramp_velocity**2 + 2. * self.max_deceleration * extra)
+        return velocity
+
+    def plan(self, distances, base_velocities, current_velocity, stop_distance=None):
+        """Returns the planned velocity for each waypoint.
+
+        Args:
+            distances (ndarray): along-track distance from the car to each waypoint
+            base_velocities (ndarray): target velocity of each waypoint
+            current_velocity (float): current speed of the car
+            stop_distance (float): along-track distance to the stop point, None to keep driving
+
+        Returns:
+            ndarray: velocities, zero at and beyond the stop point
+        """
+        distances = np.asarray(distances, dtype=np.float64)
+        velocities = np.minimum(base_velocities,
+                                np.sqrt(current_velocity**2 + 2. * self.max_acceleration * distances))
+        if stop_distance is not None:
+            velocities = np.minimum(velocities, self.braking_envelope(stop_distance - distances))
+            velocities[distances >= stop_distance] = 0.
+        return velocities
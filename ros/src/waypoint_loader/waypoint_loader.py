@@ -1,18 +1,38 @@
 #!/usr/bin/env python
 
 import os
-import csv
-import math
+import time
+import hashlib
 
-from geometry_msgs.msg import Quaternion
+import numpy as np
 
-from styx_msgs.msg import Lane, Waypoint
+from geometry_msgs.msg import PoseStamped, Quaternion
+
+from styx_msgs.msg import Lane, LaneWindow, Waypoint
 
-import tf
 import rospy
 
+from waypoint_lib import TrackIndex, save_array_atomic, export_track, withdraw_track
+
 CSV_HEADER = ['x', 'y', 'z', 'yaw']
 MAX_DECEL = 1.0
+# Columns of the compiled map: the CSV columns followed by the orientation quaternion
+MAP_COLUMNS = CSV_HEADER + ['qx', 'qy', 'qz', 'qw']
+# Where compiled maps are kept, an empty ~cache_dir disables the cache
+CACHE_DIR = os.path.join(os.environ.get('ROS_HOME', os.path.expanduser('~/.ros')), 'waypoint_cache')
+# Where the track shared with the other nodes is exported, an empty ~shared_track_dir disables the export
+SHARED_TRACK_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else CACHE_DIR
+
+
+class SubscribeCallback(rospy.SubscribeListener):
+    """Calls `callback` with the topic name whenever a node subscribes to the publisher"""
+
+    def __init__(self, callback):
+        super(SubscribeCallback, self).__init__()
+        self.callback = callback
+
+    def peer_subscribe(self, topic_name, topic_publish, peer_publish):
+        self.callback(topic_name)
 
 
 class WaypointLoader(object):
@@ -20,64 +40,173 @@ class WaypointLoader(object):
     def __init__(self):
         rospy.init_node('waypoint_loader', log_level=rospy.DEBUG)
 
-        self.pub = rospy.Publisher('/base_waypoints', Lane, queue_size=1, latch=True)
-
         self.velocity = self.kmph2mps(rospy.get_param('~velocity'))
+        self.cache_dir = rospy.get_param('~cache_dir', CACHE_DIR)
+        # with a window size, the waypoints around the car are also published on /base_waypoints_window
+        self.window_size = rospy.get_param('~window_size', 0)
+        self.publish_full_lane = rospy.get_param('~publish_full_lane', True)
+        self.shared_track_dir = rospy.get_param('~shared_track_dir', SHARED_TRACK_DIR)
+        self.track = None
+        self.lane_waypoints = None
+        self.pub = rospy.Publisher('/base_waypoints', Lane, queue_size=1, latch=True,
+                                   subscriber_listener=SubscribeCallback(self.lane_subscribed))
+        # identifies this load of the track, both on the lane and on the shared track
+        self.lane_stamp = rospy.Time.from_sec(time.time())
+        self.waypoints = None
+        self.track_index = None
+        self.window_start = None
+        if self.window_size > 0:
+            self.window_pub = rospy.Publisher('/base_waypoints_window', LaneWindow, queue_size=1, latch=True)
+        # a loader that was killed leaves its track advertised, nodes must not attach to it
+        withdraw_track()
         self.new_waypoint_loader(rospy.get_param('~path'))
         rospy.spin()
 
     def new_waypoint_loader(self, path):
         if os.path.isfile(path):
             waypoints = self.load_waypoints(path)
-            self.publish(waypoints)
+            # stored before publish_full_lane is read, so a subscriber arriving meanwhile is never missed
+            self.lane_waypoints = waypoints
+            # export before publishing, so the track is in place when the lane reaches the nodes
+            if self.shared_track_dir:
+                self.share_track()
+            if self.publish_full_lane:
+                self.publish(waypoints)
+            if self.window_size > 0:
+                self.start_windows(waypoints)
             rospy.loginfo('Waypoint Loded')
         else:
             rospy.logerr('%s is not a file', path)
 
-    def quaternion_from_yaw(self, yaw):
-        return tf.transformations.quaternion_from_euler(0., 0., yaw)
-
     def kmph2mps(self, velocity_kmph):
         return (velocity_kmph * 1000.) / (60. * 60.)
 
+    def compile_map(self, fname):
+        """Parses the waypoint CSV into an (N, len(MAP_COLUMNS)) array"""
+        rows = np.loadtxt(fname, delimiter=',', usecols=range(len(CSV_HEADER)), ndmin=2)
+        wp_map = np.zeros((len(rows), len(MAP_COLUMNS)))
+        wp_map[:, :len(CSV_HEADER)] = rows
+        # the waypoints only carry a yaw, so the quaternion is a rotation about z
+        yaw = rows[:, CSV_HEADER.index('yaw')]
+        wp_map[:, MAP_COLUMNS.index('qz')] = np.sin(yaw / 2.)
+        wp_map[:, MAP_COLUMNS.index('qw')] = np.cos(yaw / 2.)
+        return wp_map
+
+    def save_map(self, wp_map, cache_path):
+        try:
+            # a concurrent launch may load the cache while it is written
+            save_array_atomic(cache_path, wp_map)
+        except (IOError, OSError) as e:
+            rospy.logwarn('Could not cache waypoint map in %s: %s', self.cache_dir, e)
+
+    def load_map(self, fname):
+        """Returns the compiled map of `fname`.
+
+        Compiled maps are cached under a name holding the SHA-1 of the CSV, so an edited
+        CSV never matches a stale cache. A cached map is memory-mapped rather than parsed.
+        """
+        if not self.cache_dir:
+            return self.compile_map(fname)
+        with open(fname, 'rb') as wfile:
+            checksum = hashlib.sha1(wfile.read()).hexdigest()
+        cache_path = os.path.join(self.cache_dir, '%s.%s.npy' % (os.path.basename(fname), checksum))
+        if os.path.isfile(cache_path):
+            try:
+                wp_map = np.load(cache_path, mmap_mode='r')
+                if wp_map.ndim == 2 and wp_map.shape[1] == len(MAP_COLUMNS):
+                    return wp_map
+                rospy.logwarn('Ignoring waypoint cache %s with shape %s', cache_path, wp_map.shape)
+            except (IOError, ValueError) as e:
+                rospy.logwarn('Ignoring unreadable waypoint cache %s: %s', cache_path, e)
+        wp_map = self.compile_map(fname)
+        self.save_map(wp_map, cache_path)
+        return wp_map
+
     def load_waypoints(self, fname):
+        start = time.time()
+        wp_map = self.load_map(fname)
+        velocities = self.decelerate(wp_map[:, :3], np.full(len(wp_map), float(self.velocity)))
+        self.track = np.column_stack((wp_map[:, :3], velocities))
         waypoints = []
-        with open(fname) as wfile:
-            reader = csv.DictReader(wfile, CSV_HEADER)
-            for wp in reader:
-                p = Waypoint()
-                p.pose.pose.position.x = float(wp['x'])
-                p.pose.pose.position.y = float(wp['y'])
-                p.pose.pose.position.z = float(wp['z'])
-                q = self.quaternion_from_yaw(float(wp['yaw']))
-                p.pose.pose.orientation = Quaternion(*q)
-                p.twist.twist.linear.x = float(self.velocity)
-
-                waypoints.append(p)
-        return self.decelerate(waypoints)
-
-    def distance(self, p1, p2):
-        x, y, z = p1.x - p2.x, p1.y - p2.y, p1.z - p2.z
-        return math.sqrt(x*x + y*y + z*z)
-
-    def decelerate(self, waypoints):
-        last = waypoints[-1]
-        last.twist.twist.linear.x = 0.
-        for wp in waypoints[:-1][::-1]:
-            dist = self.distance(wp.pose.pose.position, last.pose.pose.position)
-            vel = math.sqrt(2 * MAX_DECEL * dist)
-            if vel < 1.:
-                vel = 0.
-            wp.twist.twist.linear.x = min(vel, wp.twist.twist.linear.x)
+        for (x, y, z, _, qx, qy, qz, qw), velocity in zip(wp_map.tolist(), velocities.tolist()):
+            p = Waypoint()
+            position = p.pose.pose.position
+            position.x, position.y, position.z = x, y, z
+            p.pose.pose.orientation = Quaternion(qx, qy, qz, qw)
+            p.twist.twist.linear.x = velocity
+
+            waypoints.append(p)
+        rospy.loginfo('Loaded %d waypoints in %.1f ms', len(waypoints), 1000. * (time.time() - start))
         return waypoints
 
+    def decelerate(self, positions, velocities):
+        """Caps `velocities` so that the car comes to rest at the last waypoint.
+
+        The distance to the end is measured along the route, as a straight line to the
+        last waypoint would understate it on a curved approach.
+        """
+        segments = np.sqrt((np.diff(positions, axis=0)**2).sum(axis=1))
+        remaining = np.concatenate((np.cumsum(segments[::-1])[::-1], [0.]))
+        limit = np.sqrt(2 * MAX_DECEL * remaining)
+        limit[limit < 1.] = 0.
+        return np.minimum(velocities, limit)
+
+    def share_track(self):
+        path = os.path.join(self.shared_track_dir, 'base_waypoints%s.npy' % rospy.get_name().replace('/', '_'))
+        try:
+            export_track(path, self.track, self.lane_stamp)
+        except (IOError, OSError) as e:
+            rospy.logwarn('Could not share the track in %s, nodes fall back to /base_waypoints: %s', path, e)
+            return
+        rospy.on_shutdown(lambda: withdraw_track(path))
+
+    def lane_subscribed(self, topic_name):
+        if self.publish_full_lane:
+            return
+        # dbw_node and tl_detector only learn the track from the lane, without it the car would not move
+        rospy.logerr('A node subscribed to %s although ~publish_full_lane is false, publishing the full lane',
+                     topic_name)
+        self.publish_full_lane = True
+        if self.lane_waypoints is not None:
+            self.publish(self.lane_waypoints)
+
     def publish(self, waypoints):
         lane = Lane()
         lane.header.frame_id = '/world'
-        lane.header.stamp = rospy.Time(0)
+        lane.header.stamp = self.lane_stamp
         lane.waypoints = waypoints
         self.pub.publish(lane)
 
+    def start_windows(self, waypoints):
+        self.waypoints = waypoints
+        if self.window_size >= len(waypoints):
+            # the whole track fits in one window, which never has to move
+            self.publish_window(0)
+            return
+        self.track_index = TrackIndex(self.track[:, :3])
+        rospy.Subscriber('/current_pose', PoseStamped, self.pose_cb, queue_size=1)
+
+    def pose_cb(self, msg):
+        index = self.track_index.closest((msg.pose.position.x, msg.pose.position.y))
+        # keep the window while the car is in its first half, so at least half a window always lies ahead
+        if self.window_start is not None and (index - self.window_start) % len(self.waypoints) < self.window_size // 2:
+            return
+        self.publish_window((index - self.window_size // 4) % len(self.waypoints))
+
+    def publish_window(self, start):
+        num_waypoints = len(self.waypoints)
+        end = start + min(self.window_size, num_waypoints)
+        window = LaneWindow()
+        window.header.frame_id = '/world'
+        window.header.stamp = rospy.Time.now()
+        window.start_index = start
+        window.track_size = num_waypoints
+        window.waypoints = self.waypoints[start:end]
+        if end > num_waypoints:
+            window.waypoints.extend(self.waypoints[:end - num_waypoints])
+        self.window_pub.publish(window)
+        self.window_start = start
+
 
 if __name__ == '__main__':
     try:
@@ -2,12 +2,14 @@
 
 import rospy
 from geometry_msgs.msg import PoseStamped, TwistStamped
-from styx_msgs.msg import Lane, Waypoint
+from styx_msgs.msg import Lane, LaneWindow, Waypoint
 from std_msgs.msg import Int32, Float64
 
 import math
 import numpy as np
 
+from waypoint_lib import TrackIndex, VelocityPlanner, attach_track
+
 '''
 This node will publish waypoints from the car's current position to some `x` distance ahead.
 
@@ -28,6 +30,54 @@ DISTANCE_AHEAD = 700 # Maximum distance ahead needed to look
 MAX_ACCELERATION = 9.0 
 MAX_JERK = 9.0
 MAX_DECELERATION = 5.0
+MAX_STOP_OVERSHOOT = 5.0 # metres. A stopping waypoint this close behind the car still holds it at rest
+
+
+class TrackState(object):
+    """Everything the updater derives from one set of base waypoints.
+
+    A new state is built on the subscriber thread whenever the waypoints change and swapped
+    in with a single assignment, so the publishing loop never mixes two sets of waypoints.
+    """
+
+    def __init__(self, lane, window_start, track_size, track=None):
+        self.waypoints = lane.waypoints
+        #Position of the waypoints within the whole track, they are the whole track unless a window is used
+        self.window_start = window_start
+        self.track_size = track_size
+        #A window of a longer track does not loop
+        self.loops = len(self.waypoints) >= track_size
+        # Build the spatial index and arc length table once so each pose update is a local lookup
+        if track is not None:
+            self.track_index = TrackIndex(track[:, :3])
+            self.base_velocities = np.array(track[:, 3])
+        else:
+            self.track_index = TrackIndex.from_lane(lane)
+            self.base_velocities = np.array([wp.twist.twist.linear.x for wp in self.waypoints])
+        self.base_waypoints = self.track_index.points
+        # Preallocate the published lane so the window publisher only swaps waypoint references
+        self.num_lookahead = min(LOOKAHEAD_WPS, len(self.waypoints))
+        self.final_waypoints = Lane()
+        self.final_waypoints.header.frame_id = lane.header.frame_id
+        self.final_waypoints.waypoints = list(self.waypoints[:self.num_lookahead])
+        self.stop_waypoints = [Waypoint() for _ in range(self.num_lookahead)]
+        #Velocity profile towards a stop line, cached per (first waypoint ahead, stopping waypoint)
+        self.velocity_profile_key = None
+        self.velocity_profile_size = 0
+
+    def local_index(self, index):
+        """Maps a waypoint index of the whole track to an index into the held waypoints, -1 when not held"""
+        if index < 0:
+            return -1
+        index = (index - self.window_start) % self.track_size
+        return index if index < len(self.waypoints) else -1
+
+    def lookahead_indices(self, start):
+        """Returns the indices of the lookahead from `start`, only wrapping around a looping track"""
+        end = start + self.num_lookahead
+        if self.loops:
+            return np.arange(start, end) % len(self.waypoints)
+        return np.arange(start, min(end, len(self.waypoints)))
 
 
 class WaypointUpdater(object):
@@ -40,13 +90,21 @@ class WaypointUpdater(object):
 
         #Get the maximum velocity parameter
         self.maximum_velocity = self.kmph2mps(rospy.get_param('~velocity')) # change km/h to m/s and subtract 1 to make sure it is always lower
+        #Publish a contiguous slice of the ordered base waypoints instead of sorting them by distance
+        self.index_window = rospy.get_param('~index_window', True)
+        self.publish_rate = rospy.get_param('~publish_rate', 50)
+        #Follow the window of base waypoints around the car instead of holding the whole track
+        self.use_waypoint_window = rospy.get_param('~use_waypoint_window', False)
 
         #Set an intial for a previous waypoint index
         self.stopping_waypoint_index = -1
         #Set the previous velocities
         self.previous_previous_velocity = 0
         self.previous_velocity = 0
-        self.base_waypoints = None
+        #The waypoints and everything derived from them, replaced as a whole when new waypoints arrive
+        self.track = None
+        self.current_velocity = 0
+        self.velocity_planner = VelocityPlanner(MAX_ACCELERATION, MAX_DECELERATION, MAX_JERK)
         self.oncoming_waypoints_distance = []
         self.transformed_xy = []
         self.oncoming_waypoints = None
@@ -56,23 +114,25 @@ class WaypointUpdater(object):
         self.final_waypoints_pub = rospy.Publisher('/final_waypoints', Lane, queue_size=1)
         # self.cte_pub = rospy.Publisher('/cross_track_error',Float64, queue_size=1)
 
-        self.base_waypoints_sub = rospy.Subscriber('/base_waypoints', Lane, self.waypoints_cb)
-        # self.current_velocity_sub = rospy.Subscriber('/current_velocity', TwistStamped, self.current_velocity_function)
+        if self.use_waypoint_window:
+            self.base_waypoints_sub = rospy.Subscriber('/base_waypoints_window', LaneWindow, self.window_cb)
+        else:
+            self.base_waypoints_sub = rospy.Subscriber('/base_waypoints', Lane, self.waypoints_cb)
+        self.current_velocity_sub = rospy.Subscriber('/current_velocity', TwistStamped, self.current_velocity_function)
         self.current_pose_sub = rospy.Subscriber('/current_pose', PoseStamped, self.pose_cb_function)
 
         # TODO: Add a subscriber for /traffic_waypoint and /obstacle_waypoint below
-        # self.traffic_waypoint = rospy.Subscriber('/traffic_waypoint', Int32, self.traffic_cb)
+        self.traffic_waypoint = rospy.Subscriber('/traffic_waypoint', Int32, self.traffic_cb)
 
-        # self.loop()
+        self.loop()
         # TODO: Add other member variables you need below
 
 
     def loop(self):
-        rate = rospy.Rate(10) # 1Hz
+        rate = rospy.Rate(self.publish_rate)
         while not rospy.is_shutdown():
-            rospy.loginfo("THE current position: " + str(self.c_position))
+            # rospy.loginfo("THE current position: " + str(self.c_position))
             self.pose_cb(self.c_position)
-            rospy.loginfo("Finished")
             rate.sleep()
 
     def kmph2mps(self, velocity_kmph):
@@ -91,40 +151,98 @@ class WaypointUpdater(object):
     def pose_cb(self, msg):
         if msg is None:
             return
-        if self.base_waypoints is None:
+        # read the state once, the subscriber thread may swap in a new one at any time
+        track = self.track
+        if track is None:
             # rospy.loginfo("THE BASE WAYPOINTS ARE NOT THERE")
             return
+        # the window is republished even when the car stands still, so a light change reaches the lane
+        if self.index_window:
+            self.publish_window(track, msg)
+            return
         # TODO: Implement
         if self.prev_pose is None:
             self.prev_pose = msg - 0.1
         if np.all(self.prev_pose == msg):
             return
+        # Only the waypoints on either side of the closest one can be among the LOOKAHEAD_WPS closest ahead
+        closest_index = track.track_index.closest(msg)
+        if len(track.base_waypoints) > 2*LOOKAHEAD_WPS + 1:
+            candidates = np.arange(closest_index - LOOKAHEAD_WPS, closest_index + LOOKAHEAD_WPS + 1) % len(track.base_waypoints)
+        else:
+            candidates = np.arange(len(track.base_waypoints))
+        candidate_waypoints = track.base_waypoints[candidates]
         # Find the waypoints in the base waypoints that are after the current position and less than 70 m away
         # obtain the distance then use the sign of the dot product
-        waypoint_distances = np.sqrt(((self.base_waypoints - msg)**2).sum(axis=1))
+        waypoint_distances = np.sqrt(((candidate_waypoints - msg)**2).sum(axis=1))
         # Find the sign of the dot product of the position vector and the base waypoints wrt the previous position
-        dot_product_sign = np.sign(np.dot(self.base_waypoints-self.prev_pose, msg-self.prev_pose))
+        dot_product_sign = np.sign(np.dot(candidate_waypoints-self.prev_pose, msg-self.prev_pose))
         # Multiply the waypoint_distances by their respective sign. Positive distances mean in front of car
         waypoint_distances = np.multiply(waypoint_distances,dot_product_sign)
         # obtain the indices of the smallest positive LOOKAHEAD_WPS. Set all negative distance values to 1,000,000 to make easier.
         waypoint_distances[np.where(waypoint_distances<0)[0]] = 1000000
-        indices = waypoint_distances.argsort()[:LOOKAHEAD_WPS].astype(int).tolist()
+        indices = candidates[waypoint_distances.argsort()[:LOOKAHEAD_WPS]].astype(int).tolist()
         # create a final_waypoints
-        self.final_waypoints = Lane()
+        final_waypoints = Lane()
         # add the waypoints to the final_waypoints with respect to the sorted distance.
         for each_index in indices:
-            self.final_waypoints.waypoints.append(self.wpts[each_index])
-        self.final_waypoints_pub.publish(self.final_waypoints)
+            final_waypoints.waypoints.append(track.waypoints[each_index])
+        self.final_waypoints_pub.publish(final_waypoints)
         # make the msg the prev_pose
         self.prev_pose = msg.copy()
 
+    def publish_window(self, track, msg):
+        # base_waypoints are ordered along the track, so the lookahead is the slice after the closest waypoint ahead
+        wpts = track.waypoints
+        lane = track.final_waypoints
+        start = track.track_index.closest_ahead(msg)
+        end = start + track.num_lookahead
+        stop_index = track.local_index(self.stopping_waypoint_index)
+        stop_distance = None
+        if stop_index >= 0:
+            stop_distance = float(track.track_index.distance(start, stop_index))
+            track_length = track.track_index.track_length
+            # a car that braked onto the line may end up just past the stopping waypoint, the distance then wraps
+            if stop_distance > track_length - MAX_STOP_OVERSHOOT:
+                stop_distance = 0.
+            elif stop_distance >= track_length / 2.:
+                stop_distance = None
+        if stop_distance is not None:
+            lane.waypoints[:] = self.plan_stop(track, start, stop_index, stop_distance)
+        # refill the preallocated lane in place, wrapping around the end of the track
+        elif end <= len(wpts):
+            lane.waypoints[:] = wpts[start:end]
+        elif not track.loops:
+            # a window does not loop, the loader moves it on before the car gets near its end
+            lane.waypoints[:] = wpts[start:]
+        else:
+            lane.waypoints[:] = wpts[start:]
+            lane.waypoints.extend(wpts[:end - len(wpts)])
+        self.final_waypoints_pub.publish(lane)
+
+    def plan_stop(self, track, start, stop_index, stop_distance):
+        # the profile only depends on the window start and the stop, so reuse it until either moves
+        if track.velocity_profile_key != (start, stop_index):
+            indices = track.lookahead_indices(start)
+            velocities = self.velocity_planner.plan(track.track_index.distance(start, indices),
+                                                    track.base_velocities[indices],
+                                                    self.current_velocity,
+                                                    stop_distance)
+            # the preallocated waypoints share the base poses so only their velocities are written
+            for waypoint, index, velocity in zip(track.stop_waypoints, indices, velocities):
+                waypoint.pose = track.waypoints[index].pose
+                waypoint.twist.twist.linear.x = velocity
+            track.velocity_profile_key = (start, stop_index)
+            track.velocity_profile_size = len(indices)
+        return track.stop_waypoints[:track.velocity_profile_size]
+
     def waypoints_cb(self, msg):
-        self.wpts = msg.waypoints
-        # TODO: Implement
-        base_waypoints = []
-        for each_waypoint in msg.waypoints:
-            base_waypoints.append([each_waypoint.pose.pose.position.x, each_waypoint.pose.pose.position.y])
-        self.base_waypoints = np.array(base_waypoints)
+        # The published lane still supplies the waypoint messages, the shared track spares rebuilding the arrays
+        shared = attach_track(len(msg.waypoints), (msg.header.stamp.secs, msg.header.stamp.nsecs))
+        self.track = TrackState(msg, 0, len(msg.waypoints), shared)
+
+    def window_cb(self, msg):
+        self.track = TrackState(msg, msg.start_index, msg.track_size)
 
     def traffic_cb(self, msg):
         #choose the model, depending upon the msg
@@ -152,12 +270,8 @@ class WaypointUpdater(object):
         waypoints[waypoint].twist.twist.linear.x = velocity
 
     def distance(self, waypoints, wp1, wp2):
-        dist = 0
-        dl = lambda a, b: math.sqrt((a.x-b.x)**2 + (a.y-b.y)**2  + (a.z-b.z)**2)
-        for i in range(wp1, wp2+1):
-            dist += dl(waypoints[wp1].pose.pose.position, waypoints[i].pose.pose.position)
-            wp1 = i
-        return dist
+        # waypoints are kept for the original signature, the precomputed arc length table answers the query
+        return self.track.track_index.distance(wp1, wp2)
 
 
 if __name__ == '__main__':